@@ -0,0 +1,89 @@
+"""Throughput of stock decrements on one hot product under concurrent writers.
+
+Compares the default path (a conditional find_one_and_update on the product
+document, as in record_sale) with STOCK_COUNTER_SLOTS mode (an $inc on one of
+N counter slots). Runs against a scratch database, which it drops afterwards.
+
+    MONGODB_URL=mongodb://localhost:27017 python benchmarks/hot_product_stock.py --writers 32 --ops 200 --slots 8
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+
+BENCH_DATABASE = "provision_store_bench"
+
+
+async def product_writer(db, product_id, ops, latencies):
+    for _ in range(ops):
+        started = time.perf_counter()
+        await db.products.find_one_and_update(
+            {"_id": product_id, "quantity": {"$gte": 1}},
+            {"$inc": {"quantity": -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        latencies.append(time.perf_counter() - started)
+
+
+async def slot_writer(db, product_id, ops, slots, latencies):
+    for _ in range(ops):
+        started = time.perf_counter()
+        await db.stock_counters.update_one(
+            {"_id": f"{product_id}:{random.randrange(slots)}"},
+            {"$inc": {"delta": -1}, "$setOnInsert": {"product_id": str(product_id)}},
+            upsert=True
+        )
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(db, mode, writers, ops, slots):
+    await db.products.drop()
+    await db.stock_counters.drop()
+    result = await db.products.insert_one({"name": "Hot Beer", "unit_price": 500, "quantity": writers * ops, "is_bottled": True})
+    product_id = result.inserted_id
+
+    latencies = []
+    started = time.perf_counter()
+    if mode == "product":
+        await asyncio.gather(*(product_writer(db, product_id, ops, latencies) for _ in range(writers)))
+    else:
+        await asyncio.gather(*(slot_writer(db, product_id, ops, slots, latencies) for _ in range(writers)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "ops_per_second": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+async def main(db, writers, ops, slots):
+    print(f"{writers} writers x {ops} decrements on one product")
+    for mode in ("product", "slots"):
+        stats = await run(db, mode, writers, ops, slots)
+        label = "single product document" if mode == "product" else f"{slots} counter slots"
+        print(f"{label:>26}: {stats['ops_per_second']:8.0f} ops/s  p50 {stats['p50_ms']:6.2f} ms  p99 {stats['p99_ms']:6.2f} ms")
+
+
+async def bench(url, writers, ops, slots):
+    client = AsyncIOMotorClient(url)
+    try:
+        await main(client[BENCH_DATABASE], writers, ops, slots)
+    finally:
+        await client.drop_database(BENCH_DATABASE)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writers", type=int, default=32, help="concurrent writers")
+    parser.add_argument("--ops", type=int, default=200, help="decrements per writer")
+    parser.add_argument("--slots", type=int, default=8, help="counter slots per product")
+    args = parser.parse_args()
+
+    asyncio.run(bench(os.getenv("MONGODB_URL", "mongodb://localhost:27017"), args.writers, args.ops, args.slots))
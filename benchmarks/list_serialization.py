@@ -0,0 +1,92 @@
+"""Per-row cost of serializing a GET /sales page, before and after FastJSONResponse.
+
+"before" is what FastAPI does with response_model=List[SaleResponse]: build
+a model per row, validate the list against the response model, dump it and
+encode it with the stdlib json module. "after" is FastJSONResponse rendering
+the pre-shaped dicts the aggregation pipeline returns, with orjson when it
+is installed and the stdlib fallback otherwise. Needs no database.
+
+    python benchmarks/list_serialization.py --rows 10000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+from bson import ObjectId
+from pydantic import TypeAdapter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def sale_rows(count):
+    started = datetime.now()
+    return [
+        {
+            "id": str(ObjectId()),
+            "product_id": str(ObjectId()),
+            "product_name": f"Product {i % 200}",
+            "quantity": 1 + i % 5,
+            "unit_price": 500.0,
+            "total_amount": 500.0 * (1 + i % 5),
+            "bottle_taken": i % 3 == 0,
+            "sold_by": "Ann",
+            "payment_method": "Cash",
+            "timestamp": started - timedelta(seconds=i)
+        }
+        for i in range(count)
+    ]
+
+
+def before(rows, adapter):
+    models = [main.SaleResponse(**row) for row in rows]
+    validated = adapter.validate_python(models, from_attributes=True)
+    return json.dumps(adapter.dump_python(validated, mode="json")).encode()
+
+
+def after(rows):
+    return main.FastJSONResponse(rows).body
+
+
+def after_stdlib(rows):
+    orjson, main.orjson = main.orjson, None
+    try:
+        return main.FastJSONResponse(rows).body
+    finally:
+        main.orjson = orjson
+
+
+def measure(label, serialize, rows, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = serialize(rows)
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    print(f"{label:>24}: {best * 1000:8.1f} ms  {best / len(rows) * 1e6:6.2f} us/row  {len(body) / 1024:7.0f} KiB")
+    return best
+
+
+def run(count, repeat):
+    rows = sale_rows(count)
+    adapter = TypeAdapter(List[main.SaleResponse])
+    assert json.loads(before(rows, adapter)) == json.loads(after(rows)) == json.loads(after_stdlib(rows))
+
+    print(f"{count} sale rows, best of {repeat}")
+    slow = measure("response_model", lambda rows: before(rows, adapter), rows, repeat)
+    fast = measure("FastJSONResponse" + (" (orjson)" if main.orjson else ""), after, rows, repeat)
+    measure("FastJSONResponse (json)", after_stdlib, rows, repeat)
+    print(f"{slow / fast:.1f}x faster")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000, help="sale rows per page")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per variant")
+    args = parser.parse_args()
+
+    run(args.rows, args.repeat)
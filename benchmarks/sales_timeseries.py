@@ -0,0 +1,125 @@
+"""Range-scan speed and storage size of sales in a regular vs a time-series collection.
+
+Loads the same year of synthetic sales into a regular collection (as in
+SALES_STORAGE=collection) and a time-series collection (as in
+SALES_STORAGE=timeseries), each with the timestamp index GET /sales uses.
+Then times day, week and month range scans and a daily-total aggregation,
+and reports data and index sizes. Runs against a scratch database, which it
+drops afterwards. Time-series collections need MongoDB 5.0+.
+
+    MONGODB_URL=mongodb://localhost:27017 python benchmarks/sales_timeseries.py --per-day 300
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+BENCH_DATABASE = "provision_store_bench"
+SELLERS = ["Ann", "Bola", "Chidi", "Dayo"]
+PAYMENT_METHODS = ["Cash", "POS", "Transfer", "Credit"]
+PRODUCTS = [(str(ObjectId()), f"Product {i}", random.choice([200, 500, 800, 1500])) for i in range(150)]
+
+
+def synthetic_sales(start, days, per_day):
+    for day in range(days):
+        opening = start + timedelta(days=day, hours=8)
+        for _ in range(per_day):
+            product_id, name, price = random.choice(PRODUCTS)
+            quantity = random.randint(1, 6)
+            sold_by = random.choice(SELLERS)
+            payment_method = random.choice(PAYMENT_METHODS)
+            yield {
+                "_id": ObjectId(),
+                "product_id": product_id,
+                "product_name": name,
+                "product_name_lc": name.lower(),
+                "quantity": quantity,
+                "unit_price": price,
+                "total_amount": price * quantity,
+                "bottle_taken": False,
+                "sold_by": sold_by,
+                "sold_by_lc": sold_by.lower(),
+                "payment_method": payment_method,
+                "customer_id": None,
+                "timestamp": opening + timedelta(seconds=random.randrange(14 * 3600)),
+                "meta": {"sold_by": sold_by, "payment_method": payment_method}
+            }
+
+
+async def load(collection, sales, batch_size=5000):
+    started = time.perf_counter()
+    for i in range(0, len(sales), batch_size):
+        await collection.insert_many(sales[i:i + batch_size], ordered=False)
+    await collection.create_index([("timestamp", -1), ("_id", -1)])
+    return time.perf_counter() - started
+
+
+async def timed(coroutine_factory, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await coroutine_factory()
+        timings.append(time.perf_counter() - started)
+    return sorted(timings)[len(timings) // 2] * 1000
+
+
+async def range_scan(collection, start, end):
+    return await collection.find({"timestamp": {"$gte": start, "$lt": end}}).sort([("timestamp", -1), ("_id", -1)]).to_list(None)
+
+
+async def daily_totals(collection, start, end):
+    return await collection.aggregate([
+        {"$match": {"timestamp": {"$gte": start, "$lt": end}}},
+        {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}}, "total": {"$sum": "$total_amount"}}}
+    ]).to_list(None)
+
+
+async def storage(collection):
+    stats = await collection.aggregate([{"$collStats": {"storageStats": {}}}]).to_list(1)
+    storage_stats = stats[0]["storageStats"]
+    return storage_stats.get("storageSize", 0), storage_stats.get("totalIndexSize", 0)
+
+
+async def main(db, days, per_day):
+    start = datetime(2025, 1, 1)
+    sales = list(synthetic_sales(start, days, per_day))
+    await db.drop_collection("sales")
+    await db.drop_collection("sales_ts")
+    await db.create_collection("sales_ts", timeseries={"timeField": "timestamp", "metaField": "meta", "granularity": "minutes"})
+    print(f"{len(sales)} sales over {days} days")
+
+    middle = start + timedelta(days=days // 2)
+    ranges = [("1 day", timedelta(days=1)), ("1 week", timedelta(days=7)), ("1 month", timedelta(days=30))]
+    for name in ("sales", "sales_ts"):
+        collection = db[name]
+        load_seconds = await load(collection, [dict(sale) for sale in sales])
+        storage_size, index_size = await storage(collection)
+        label = "regular" if name == "sales" else "time-series"
+        print(f"{label:>12}: load {load_seconds:6.1f} s  storage {storage_size / 2**20:7.1f} MiB  indexes {index_size / 2**20:6.1f} MiB")
+        for range_name, span in ranges:
+            scan_ms = await timed(lambda: range_scan(collection, middle, middle + span))
+            print(f"{'':>12}  scan {range_name:<8} {scan_ms:8.1f} ms")
+        totals_ms = await timed(lambda: daily_totals(collection, start, start + timedelta(days=days)))
+        print(f"{'':>12}  daily totals for the year {totals_ms:8.1f} ms")
+
+
+async def bench(url, days, per_day):
+    client = AsyncIOMotorClient(url)
+    try:
+        await main(client[BENCH_DATABASE], days, per_day)
+    finally:
+        await client.drop_database(BENCH_DATABASE)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=int, default=365, help="days of sales")
+    parser.add_argument("--per-day", type=int, default=300, help="sales per day")
+    args = parser.parse_args()
+
+    asyncio.run(bench(os.getenv("MONGODB_URL", "mongodb://localhost:27017"), args.days, args.per_day))
@@ -1,25 +1,58 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Body
+from fastapi import FastAPI, HTTPException, Depends, status, Body, Header, Query, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from pydantic import BaseModel, Field
 from typing import Optional, List
-from datetime import datetime, timedelta
-from bson import ObjectId
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId, json_util
+import asyncio
+import base64
+import csv
+import gzip
 import hashlib
+import hmac
+import json
 import os
+import random
+import re
+import secrets
+import sys
+import time
+from collections import OrderedDict, deque
 import uvicorn
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
-from io import BytesIO
+from io import BytesIO, StringIO
 from reportlab.pdfgen import canvas
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 load_dotenv()
 
 # MongoDB connection
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 DATABASE_NAME = "provision_store"
 
+# Sale storage: "collection" keeps sales in the regular `sales` collection,
+# "timeseries" in the `sales_ts` time-series collection (MongoDB 7.0+), which
+# `python main.py migrate-sales-timeseries` fills from `sales`
+SALES_STORAGE = os.getenv("SALES_STORAGE", "collection")
+TIMESERIES_SALES = SALES_STORAGE == "timeseries"
+TIMESERIES_COLLECTION = "sales_ts"
+SALES_COLLECTION = TIMESERIES_COLLECTION if TIMESERIES_SALES else "sales"
+
 app = FastAPI(title="Smart Inventory & Sales Tracking", version="1.0.0")
 app.add_middleware(
     CORSMiddleware,
@@ -27,6 +60,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 security = HTTPBearer()
 
@@ -36,10 +70,110 @@ db = client[DATABASE_NAME]
 
 # Collections
 products_collection = db.products
-sales_collection = db.sales
+sales_collection = db[SALES_COLLECTION]
 bottles_collection = db.bottles
 settings_collection = db.settings
 undo_log_collection = db.undo_log
+idempotency_collection = db.idempotency_keys
+stock_counters_collection = db.stock_counters
+inventory_ledger_collection = db.inventory_ledger
+inventory_snapshots_collection = db.inventory_snapshots
+daily_stats_collection = db.daily_stats
+
+# Sale ingestion: "direct" inserts each sale, "journal" writes it to a local
+# journal and inserts in micro-batches from a background task
+SALES_INGEST_MODE = os.getenv("SALES_INGEST_MODE", "direct")
+SALES_JOURNAL_PATH = os.getenv("SALES_JOURNAL_PATH", "sales_journal.ndjson")
+SALES_FLUSH_INTERVAL_MS = float(os.getenv("SALES_FLUSH_INTERVAL_MS", "20"))
+SALES_FLUSH_BATCH = int(os.getenv("SALES_FLUSH_BATCH", "100"))
+
+# Sharded stock counters for hot products: 0 disables, N spreads single-sale
+# decrements over N counter documents per product that are folded back into
+# products.quantity every STOCK_FOLD_INTERVAL_SECONDS
+STOCK_COUNTER_SLOTS = int(os.getenv("STOCK_COUNTER_SLOTS", "0"))
+STOCK_FOLD_INTERVAL_SECONDS = float(os.getenv("STOCK_FOLD_INTERVAL_SECONDS", "5"))
+
+# Per-product stock snapshots that bound inventory history queries
+INVENTORY_SNAPSHOT_HOURS = float(os.getenv("INVENTORY_SNAPSHOT_HOURS", "24"))
+
+# Idempotency-Key results are kept this long in Mongo, plus an in-process LRU
+IDEMPOTENCY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "1000"))
+# A claim still pending after this long belongs to a request that died and may be retried
+IDEMPOTENCY_PENDING_SECONDS = float(os.getenv("IDEMPOTENCY_PENDING_SECONDS", "60"))
+
+# Undo: recent sales are kept in a per-process ring buffer of UNDO_BUFFER_SIZE
+# entries. With several workers set UNDO_SCOPE=shared so undo claims the
+# newest entry across all workers from the undo_log collection instead.
+UNDO_BUFFER_SIZE = int(os.getenv("UNDO_BUFFER_SIZE", "100"))
+UNDO_SCOPE = os.getenv("UNDO_SCOPE", "process")
+
+# Keyset pagination; the next page's cursor is returned in X-Next-Cursor
+DEFAULT_SALES_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Responses of at least COMPRESSION_MIN_BYTES are gzip/brotli compressed when the client accepts it
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSION_CACHE_SIZE = int(os.getenv("COMPRESSION_CACHE_SIZE", "32"))
+
+# Settings cache
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "30"))
+SETTINGS_CHANGE_STREAM = os.getenv("SETTINGS_CHANGE_STREAM", "false").lower() == "true"
+
+# Product catalog cache
+CATALOG_CHANGE_STREAM = os.getenv("CATALOG_CHANGE_STREAM", "false").lower() == "true"
+
+# Session tokens
+TOKEN_SECRET = os.getenv("TOKEN_SECRET")
+TOKEN_TTL_HOURS = float(os.getenv("TOKEN_TTL_HOURS", "12"))
+
+# Indexes for every query the API issues: (collection, keys, options).
+# ensure_indexes() creates missing ones at startup and reports drift.
+INDEXES = [
+    ("products", [("name", 1)], {"unique": True}),
+    ("products", [("barcode", 1)], {"unique": True, "partialFilterExpression": {"barcode": {"$type": "string"}}}),
+    (SALES_COLLECTION, [("timestamp", -1), ("_id", -1)], {}),
+    (SALES_COLLECTION, [("sold_by", 1), ("timestamp", -1)], {}),
+    (SALES_COLLECTION, [("customer_id", 1), ("payment_method", 1)], {}),
+    (SALES_COLLECTION, [("sold_by_lc", 1), ("timestamp", -1)], {}),
+    (SALES_COLLECTION, [("product_name_lc", 1), ("timestamp", -1)], {}),
+    (SALES_COLLECTION, [("items.product_name_lc", 1), ("timestamp", -1)], {}),
+    (SALES_COLLECTION, [("client_ref", 1)], {"unique": True, "partialFilterExpression": {"client_ref": {"$type": "string"}}}),
+    ("bottles", [("product_id", 1)], {"unique": True}),
+    ("stock_counters", [("product_id", 1)], {}),
+    ("inventory_ledger", [("product_id", 1), ("timestamp", -1), ("_id", -1)], {}),
+    ("inventory_ledger", [("sale_id", 1)], {"partialFilterExpression": {"sale_id": {"$type": "string"}}}),
+    ("inventory_ledger", [("timestamp", 1)], {}),
+    ("inventory_snapshots", [("product_id", 1), ("timestamp", -1)], {}),
+    ("idempotency_keys", [("key", 1)], {"unique": True}),
+    ("idempotency_keys", [("created_at", 1)], {"expireAfterSeconds": int(IDEMPOTENCY_TTL_HOURS * 3600)}),
+    ("undo_log", [("timestamp", -1)], {}),
+]
+
+def undo_window(settings: dict) -> timedelta:
+    return timedelta(minutes=settings.get("undo_window_minutes", 5))
+
+def index_registry(settings: dict) -> list:
+    # undo_log entries expire through a TTL index sized to the configured undo
+    # window. TTL indexes compare against UTC, so it is on created_at rather
+    # than the local sale timestamp
+    ttl_seconds = int(undo_window(settings).total_seconds())
+    registry = INDEXES + [("undo_log", [("created_at", 1)], {"expireAfterSeconds": ttl_seconds})]
+    if TIMESERIES_SALES:
+        # Time-series collections can't have unique indexes and come with a
+        # (metaField, timeField) index of their own
+        registry = [
+            (collection, keys, {option: value for option, value in options.items() if option != "unique"} if collection == SALES_COLLECTION else options)
+            for collection, keys, options in registry
+        ]
+        registry.append((SALES_COLLECTION, [("meta", 1), ("timestamp", 1)], {}))
+    return registry
+
+# Long-running tasks started at startup and cancelled at shutdown
+background_tasks = []
+
+# Transactions need a replica set or sharded cluster; detected at startup
+transactions_supported = False
 
 # Pydantic Models
 class Product(BaseModel):
@@ -67,7 +201,7 @@ class ProductUpdate(BaseModel):
 
 class Sale(BaseModel):
     product_id: str
-    quantity: int
+    quantity: int = Field(..., gt=0)
     bottle_taken: bool = False
     sold_by: str
     payment_method: str = Field(..., pattern="^(Cash|POS|Transfer|Credit)$")
@@ -87,7 +221,7 @@ class SaleResponse(BaseModel):
 
 class SaleItem(BaseModel):
     product_id: str
-    quantity: int
+    quantity: int = Field(..., gt=0)
     bottle_taken: bool = False
 
 class MultiSale(BaseModel):
@@ -104,6 +238,29 @@ class MultiSaleResponse(BaseModel):
     total_amount: float
     timestamp: datetime
 
+class BatchSale(BaseModel):
+    client_ref: str  # Client-generated id; re-uploading the same sale is reported as a duplicate
+    timestamp: datetime
+    sold_by: str
+    payment_method: str = Field(..., pattern="^(Cash|POS|Transfer|Credit)$")
+    customer_id: Optional[str] = None
+    # Either a single product...
+    product_id: Optional[str] = None
+    quantity: Optional[int] = Field(None, gt=0)
+    bottle_taken: bool = False
+    # ...or a basket
+    items: Optional[List[SaleItem]] = None
+
+class SaleBatch(BaseModel):
+    sales: List[BatchSale] = Field(..., max_length=1000)
+
+class BatchSaleResult(BaseModel):
+    index: int
+    client_ref: str
+    status: str  # recorded, duplicate or rejected
+    id: Optional[str] = None
+    detail: Optional[str] = None
+
 class BottleReturn(BaseModel):
     product_name: str
     bottles_returned: int
@@ -119,12 +276,41 @@ class PinAuth(BaseModel):
 class DailySummary(BaseModel):
     date: str
     total_sales_amount: float
+    sales_count: int = 0
     sales_by_seller: dict
+    sales_by_payment_method: dict = {}
+    quantity_by_product: dict = {}
     bottles_taken: int
     bottles_returned: int
     outstanding_bottles: int
     low_stock_products: List[ProductResponse]
 
+class RangeBucket(BaseModel):
+    start: datetime
+    total_sales_amount: float
+    sales_count: int
+    sales_by_seller: dict
+    sales_by_payment_method: dict
+    sales_by_product: dict  # product name -> {"quantity", "amount"}
+
+class RangeSummary(BaseModel):
+    start: datetime
+    end: datetime
+    granularity: str
+    rollup_days: int  # whole days read from daily_stats instead of the sales
+    buckets: List[RangeBucket]
+
+class Restock(BaseModel):
+    quantity: int = Field(..., gt=0)
+
+class StockMovement(BaseModel):
+    id: str
+    product_id: str
+    kind: str  # sale, undo, restock or adjustment
+    delta: int
+    sale_id: Optional[str] = None
+    timestamp: datetime
+
 class Customer(BaseModel):
     name: str
     phone: Optional[str] = None
@@ -140,76 +326,1024 @@ class CustomerResponse(BaseModel):
 def hash_pin(pin: str) -> str:
     return hashlib.sha256(pin.encode()).hexdigest()
 
-def product_dict_to_response(product_dict: dict) -> ProductResponse:
+def product_row(product_dict: dict) -> dict:
+    # ProductResponse fields as a plain dict, so list endpoints can serialize
+    # trusted catalog data without building a model per row
     low_stock_threshold = 5  # Default threshold
-    return ProductResponse(
-        id=str(product_dict["_id"]),
-        name=product_dict["name"],
-        unit_price=product_dict["unit_price"],
-        quantity=product_dict["quantity"],
-        is_bottled=product_dict["is_bottled"],
-        low_stock=product_dict["quantity"] < low_stock_threshold
-    )
+    return {
+        "id": str(product_dict["_id"]),
+        "name": product_dict["name"],
+        "unit_price": float(product_dict["unit_price"]),
+        "quantity": product_dict["quantity"],
+        "is_bottled": product_dict["is_bottled"],
+        "barcode": product_dict.get("barcode"),
+        "low_stock": product_dict["quantity"] < low_stock_threshold
+    }
 
-async def verify_pin(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    settings = await settings_collection.find_one({})
-    if not settings or "pin" not in settings:
-        # Initialize default PIN if not set
-        default_pin_hash = hash_pin("1234")
-        await settings_collection.insert_one({"pin": default_pin_hash, "low_stock_threshold": 5})
-        stored_pin_hash = default_pin_hash
-    else:
-        stored_pin_hash = settings["pin"]
+def product_dict_to_response(product_dict: dict) -> ProductResponse:
+    return ProductResponse(**product_row(product_dict))
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def dump_json(content) -> bytes:
+    # Plain dicts only; orjson handles datetimes natively
+    if orjson:
+        return orjson.dumps(content, default=json_default)
+    return json.dumps(content, default=json_default).encode()
+
+class FastJSONResponse(Response):
+    """JSON response for already-shaped dicts from the catalog or Mongo.
+
+    Returned directly, so FastAPI neither validates it against the
+    response_model nor runs it through jsonable_encoder.
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dump_json(content)
+
+def sparse_fields(fields: Optional[str], model) -> Optional[list]:
+    # Parses a fields= selection; None means every field of the model
+    if fields is None:
+        return None
+    requested = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    unknown = [name for name in requested if name not in model.model_fields]
+    if unknown or not requested:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(unknown) or fields!r}. Available: {', '.join(model.model_fields)}"
+        )
+    return requested
+
+def trim_fields(rows: list, fields: Optional[list]) -> list:
+    if not fields:
+        return rows
+    return [{name: row.get(name) for name in fields} for row in rows]
+
+def normalize_barcode(barcode: Optional[str]) -> Optional[str]:
+    if barcode is None:
+        return None
+    return barcode.strip() or None
+
+class SettingsCache:
+    """Keeps the settings document in memory so auth doesn't hit Mongo per request.
+
+    Entries expire after `ttl` seconds; writers call `invalidate()` so the next
+    read reloads. With several workers, enable SETTINGS_CHANGE_STREAM to have
+    every process invalidate on changes made by the others.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.settings = None
+        self.loaded_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def is_fresh(self) -> bool:
+        return self.settings is not None and time.monotonic() - self.loaded_at < self.ttl
+
+    async def get(self) -> dict:
+        if self.is_fresh():
+            self.hits += 1
+            return self.settings
+        self.misses += 1
+        settings = await settings_collection.find_one({})
+        if not settings or "pin" not in settings:
+            # Initialize default PIN if not set
+            await settings_collection.update_one(
+                {},
+                {"$set": {"pin": hash_pin("1234")}, "$setOnInsert": {"low_stock_threshold": 5}},
+                upsert=True
+            )
+            settings = await settings_collection.find_one({})
+        if "token_secret" not in settings:
+            # Shared signing key so tokens issued by one worker verify on the others
+            await settings_collection.update_one(
+                {"_id": settings["_id"], "token_secret": {"$exists": False}},
+                {"$set": {"token_secret": secrets.token_hex(32)}}
+            )
+            settings = await settings_collection.find_one({})
+        self.settings = settings
+        self.loaded_at = time.monotonic()
+        return settings
+
+    def invalidate(self):
+        self.settings = None
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "ttl_seconds": self.ttl}
+
+settings_cache = SettingsCache(SETTINGS_CACHE_TTL)
+
+class BarcodeIndex:
+    """In-process barcode -> product id map for scanner lookups.
+
+    Loaded at startup and kept in sync by the product endpoints. The unique
+    partial index on products.barcode stays the source of truth: misses fall
+    back to it, so products added by other workers are still found.
+    """
+
+    def __init__(self):
+        self.product_ids = {}
+        self.barcodes = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self):
+        self.product_ids.clear()
+        self.barcodes.clear()
+        async for product in products_collection.find({"barcode": {"$type": "string"}}, {"barcode": 1}):
+            self.set(str(product["_id"]), product["barcode"])
+
+    def get(self, barcode: str) -> Optional[str]:
+        return self.product_ids.get(barcode)
+
+    def set(self, product_id: str, barcode: Optional[str]):
+        self.discard(product_id)
+        if barcode:
+            self.product_ids[barcode] = product_id
+            self.barcodes[product_id] = barcode
+
+    def discard(self, product_id: str):
+        barcode = self.barcodes.pop(product_id, None)
+        if barcode is not None and self.product_ids.get(barcode) == product_id:
+            del self.product_ids[barcode]
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.product_ids)}
+
+barcode_index = BarcodeIndex()
+
+class ProductCatalog:
+    """Write-through in-memory copy of the products collection.
+
+    Loaded once at startup; the product endpoints and the sale paths apply
+    their changes here after writing to Mongo. Every change bumps `version`,
+    which backs the ETag of GET /products and keys the cached JSON payload.
+    With several workers, enable CATALOG_CHANGE_STREAM so writes made by
+    other processes are applied too.
+    """
+
+    def __init__(self):
+        self.products = {}
+        self.version = 0
+        self.instance = secrets.token_hex(4)
+        self.payload_cache = None
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self):
+        self.products = {str(product["_id"]): product async for product in products_collection.find()}
+        self.version += 1
+
+    def get(self, product_id: str) -> Optional[dict]:
+        return self.products.get(product_id)
+
+    def find_by_name(self, name: str) -> Optional[dict]:
+        return next((product for product in self.products.values() if product["name"] == name), None)
+
+    def all(self) -> list:
+        return list(self.products.values())
+
+    def put(self, product: dict):
+        self.products[str(product["_id"])] = product
+        self.version += 1
+
+    def remove(self, product_id: str):
+        if self.products.pop(product_id, None) is not None:
+            self.version += 1
+
+    def adjust_quantity(self, product_id: str, delta: int):
+        product = self.products.get(product_id)
+        if product is not None:
+            self.products[product_id] = {**product, "quantity": product["quantity"] + delta}
+            self.version += 1
+
+    def reserve(self, quantities: dict) -> bool:
+        # Takes all the quantities or none; synchronous, so no other request
+        # can check stock in between
+        if any(product_id not in self.products or self.products[product_id]["quantity"] < quantity for product_id, quantity in quantities.items()):
+            return False
+        for product_id, quantity in quantities.items():
+            self.adjust_quantity(product_id, -quantity)
+        return True
+
+    def release(self, quantities: dict):
+        for product_id, quantity in quantities.items():
+            self.adjust_quantity(product_id, quantity)
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.instance}-{self.version}"'
+
+    def payload(self, fields: Optional[list] = None) -> bytes:
+        # JSON body of GET /products (per fields= selection), rebuilt only
+        # when the version changes
+        if not self.payload_cache or self.payload_cache[0] != self.version:
+            self.payload_cache = (self.version, {})
+        bodies = self.payload_cache[1]
+        key = tuple(fields or ())
+        if key in bodies:
+            self.hits += 1
+            return bodies[key]
+        self.misses += 1
+        rows = [product_row(product) for product in self.products.values()]
+        bodies[key] = dump_json(trim_fields(rows, fields))
+        return bodies[key]
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.products), "version": self.version}
+
+product_catalog = ProductCatalog()
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    return brotli.compress(body, quality=5) if encoding == "br" else gzip.compress(body, compresslevel=6, mtime=0)
+
+class CompressedBodies:
+    """LRU of compressed response bodies keyed by (ETag, encoding).
+
+    An ETag identifies one version of versioned content such as the product
+    catalog, so each version is compressed once per encoding.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.bodies = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, etag: str, encoding: str, body: bytes) -> bytes:
+        key = (etag, encoding)
+        if key in self.bodies:
+            self.hits += 1
+            self.bodies.move_to_end(key)
+            return self.bodies[key]
+        self.misses += 1
+        data = self.bodies[key] = compress_body(body, encoding)
+        while len(self.bodies) > self.max_size:
+            self.bodies.popitem(last=False)
+        return data
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.bodies), "brotli": brotli is not None}
+
+compressed_bodies = CompressedBodies(COMPRESSION_CACHE_SIZE)
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.replace(" ", "").partition("q=")[2]
+        try:
+            if q and float(q) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(name.strip())
+    if brotli and "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+class CompressionMiddleware:
+    """Pure ASGI gzip/brotli for buffered responses of at least `minimum_size` bytes.
+
+    Streamed responses (more than one body message), responses that already
+    have a Content-Encoding and non-text content types pass through as is.
+    Bodies with an ETag are compressed through `compressed_bodies`.
+    """
+
+    def __init__(self, app, minimum_size: int):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_headers = dict((name.lower(), value) for name, value in scope["headers"])
+        encoding = choose_encoding(request_headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if not encoding:
+            return await self.app(scope, receive, send)
+
+        start = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, passthrough
+            if passthrough:
+                return await send(message)
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            headers = dict((name.lower(), value) for name, value in start["headers"])
+            body = message.get("body", b"")
+            content_type = headers.get(b"content-type", b"").decode("latin-1")
+            if (
+                message.get("more_body", False)
+                or b"content-encoding" in headers
+                or len(body) < self.minimum_size
+                or not content_type.startswith(COMPRESSIBLE_TYPES)
+            ):
+                passthrough = True
+                await send(start)
+                return await send(message)
+            etag = headers.get(b"etag", b"").decode("latin-1")
+            data = compressed_bodies.get(etag, encoding, body) if etag else compress_body(body, encoding)
+            vary = headers.get(b"vary", b"")
+            new_headers = [
+                (name, value) for name, value in start["headers"]
+                if name.lower() not in (b"content-length", b"etag", b"vary")
+            ]
+            new_headers += [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(data)).encode()),
+                (b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding")
+            ]
+            if etag:
+                # The compressed body is another representation of the same version
+                new_headers.append((b"etag", (etag if etag.startswith("W/") else "W/" + etag).encode()))
+            await send({**start, "headers": new_headers})
+            await send({"type": "http.response.body", "body": data})
+
+        await self.app(scope, receive, send_compressed)
+
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_BYTES)
+
+class SaleJournal:
+    """Write-behind buffer for single sales (SALES_INGEST_MODE=journal).
+
+    `append()` returns once the sale is written to an append-only NDJSON
+    journal and fsynced. Sales appended while an fsync is running share the
+    next one (group commit), and the write runs in a thread so the event
+    loop never waits on the disk. A background task inserts journaled sales
+    with insert_many every `interval` seconds or as soon as `batch_size` are
+    waiting, then truncates the journal. Sales carry their own _id, so
+    replaying a journal left by a crash skips whatever already reached Mongo.
+    Use one journal per worker.
+    """
+
+    def __init__(self, path: str, interval: float, batch_size: int):
+        self.path = path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = []
+        self.unsynced = []
+        self.synced = None
+        self.syncer = None
+        self.file = None
+        self.wakeup = None
+        self.lock = None
+        self.file_lock = None
+        self.flushed = 0
+        self.syncs = 0
+
+    async def start(self):
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.file_lock = asyncio.Lock()
+        await self.replay()
+        self.file = open(self.path, "a")
+        background_tasks.append(asyncio.create_task(self.run()))
+
+    async def replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as journal:
+            sales = [json_util.loads(line) for line in journal if line.strip()]
+        if sales and TIMESERIES_SALES:
+            # Time-series collections don't enforce a unique _id, so skip
+            # sales that reached Mongo before the crash explicitly
+            stored = {sale["_id"] async for sale in sales_collection.find({"_id": {"$in": [sale["_id"] for sale in sales]}}, {"_id": 1})}
+            sales = [sale for sale in sales if sale["_id"] not in stored]
+        if sales:
+            await self.insert(sales)
+            print(f"Replayed {len(sales)} journaled sales")
+        open(self.path, "w").close()
+
+    async def append(self, sale_record: dict):
+        if not self.unsynced:
+            self.synced = asyncio.get_running_loop().create_future()
+        self.unsynced.append(sale_record)
+        synced = self.synced
+        if self.syncer is None or self.syncer.done():
+            self.syncer = asyncio.create_task(self.sync())
+        await asyncio.shield(synced)
+
+    def write(self, lines: str):
+        self.file.write(lines)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    async def sync(self):
+        # One write and fsync for every sale appended since the last one
+        while self.unsynced:
+            sales, synced = self.unsynced, self.synced
+            self.unsynced = []
+            try:
+                async with self.file_lock:
+                    await asyncio.to_thread(self.write, "".join(json_util.dumps(sale) + "\n" for sale in sales))
+                    self.pending.extend(sales)
+            except Exception as e:
+                synced.set_exception(e)
+                continue
+            self.syncs += 1
+            synced.set_result(None)
+            if len(self.pending) >= self.batch_size:
+                self.wakeup.set()
+
+    def get(self, sale_id: ObjectId) -> Optional[dict]:
+        return next((sale for sale in self.pending if sale["_id"] == sale_id), None)
+
+    async def insert(self, sales: list):
+        try:
+            await sales_collection.insert_many(sales, ordered=False)
+        except BulkWriteError as e:
+            # Duplicates are sales a previous flush or replay already stored
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+
+    async def flush(self):
+        async with self.lock:
+            while True:
+                while self.pending:
+                    batch = self.pending[:self.batch_size]
+                    await self.insert(batch)
+                    del self.pending[:len(batch)]
+                    self.flushed += len(batch)
+                # Synced sales join pending under the file lock, so with
+                # nothing pending every journaled sale is in Mongo
+                async with self.file_lock:
+                    if not self.pending:
+                        self.file.seek(0)
+                        self.file.truncate()
+                        return
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Sale journal flush failed, retrying: {e}")
+
+    async def close(self):
+        if self.syncer is not None:
+            await self.syncer
+        await self.flush()
+        self.file.close()
+
+    def stats(self) -> dict:
+        return {"pending": len(self.pending) + len(self.unsynced), "flushed": self.flushed, "fsyncs": self.syncs}
+
+class StockCounters:
+    """Spreads stock decrements for hot products over several counter documents.
+
+    Single sales `$inc` a random slot's `delta` instead of the product document,
+    so concurrent writers don't serialize on one document. A product's stock is
+    `products.quantity` plus its slots' deltas; the catalog keeps that total in
+    memory and is the oversell check, which is why this mode is meant for a
+    single worker. `fold()` moves the deltas back into products.quantity; it
+    runs periodically and before any path that reads quantity from Mongo.
+    """
+
+    def __init__(self, slots: int, interval: float):
+        self.slots = slots
+        self.interval = interval
+        self.dirty = set()
+        self.folds = 0
+
+    async def take(self, product_id: str, quantity: int):
+        slot = random.randrange(self.slots)
+        await stock_counters_collection.update_one(
+            {"_id": f"{product_id}:{slot}"},
+            {"$inc": {"delta": -quantity}, "$setOnInsert": {"product_id": product_id}},
+            upsert=True
+        )
+        self.dirty.add(product_id)
+
+    async def fold(self, product_ids=None):
+        query = {"delta": {"$ne": 0}}
+        if product_ids is not None:
+            query["product_id"] = {"$in": list(product_ids)}
+        slots = await stock_counters_collection.find(query).to_list(None)
+        if not slots:
+            return
+        totals = {}
+        for slot in slots:
+            totals[slot["product_id"]] = totals.get(slot["product_id"], 0) + slot["delta"]
+        
+        # $inc by the observed delta (not $set 0) keeps decrements that land mid-fold
+        async def apply(session):
+            await products_collection.bulk_write([
+                UpdateOne({"_id": ObjectId(product_id)}, {"$inc": {"quantity": delta}})
+                for product_id, delta in totals.items()
+            ], ordered=False, session=session)
+            await stock_counters_collection.bulk_write([
+                UpdateOne({"_id": slot["_id"]}, {"$inc": {"delta": -slot["delta"]}})
+                for slot in slots
+            ], ordered=False, session=session)
+        
+        await run_in_transaction(apply)
+        self.folds += 1
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            dirty, self.dirty = self.dirty, set()
+            if not dirty:
+                continue
+            try:
+                await self.fold(dirty)
+            except asyncio.CancelledError:
+                self.dirty |= dirty
+                raise
+            except Exception as e:
+                self.dirty |= dirty
+                print(f"Stock counter fold failed, retrying: {e}")
+
+    def stats(self) -> dict:
+        return {"slots": self.slots, "folds": self.folds, "dirty_products": len(self.dirty)}
+
+stock_counters = StockCounters(STOCK_COUNTER_SLOTS, STOCK_FOLD_INTERVAL_SECONDS) if STOCK_COUNTER_SLOTS > 0 else None
+
+class IdempotencyStore:
+    """Stored responses for requests sent with an Idempotency-Key header.
+
+    Keys live in the idempotency_keys collection (unique, expiring via TTL)
+    with an LRU of completed responses in front. `begin()` either claims a new
+    key or returns the response recorded for it, in one round trip at most.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.responses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def remember(self, key: str, entry: dict):
+        self.responses[key] = entry
+        self.responses.move_to_end(key)
+        while len(self.responses) > self.max_size:
+            self.responses.popitem(last=False)
+
+    @staticmethod
+    def check(entry: dict, scope: str, fingerprint: str):
+        if entry["scope"] != scope or entry["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        if entry["status"] != "done":
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+
+    async def begin(self, key: str, scope: str, fingerprint: str) -> Optional[dict]:
+        entry = self.responses.get(key)
+        if entry:
+            self.hits += 1
+            self.responses.move_to_end(key)
+            self.check(entry, scope, fingerprint)
+            return entry["response"]
+        self.misses += 1
+        claim = {"key": key, "scope": scope, "fingerprint": fingerprint, "status": "pending", "created_at": datetime.now(timezone.utc)}
+        try:
+            existing = await idempotency_collection.find_one_and_update(
+                {"key": key}, {"$setOnInsert": claim}, upsert=True, return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            existing = await idempotency_collection.find_one({"key": key})
+        if existing is None:
+            return None
+        if existing["status"] == "pending":
+            # A worker that died mid-request never completes or releases its claim
+            reclaimed = await idempotency_collection.find_one_and_update(
+                {"key": key, "status": "pending", "created_at": {"$lt": claim["created_at"] - timedelta(seconds=IDEMPOTENCY_PENDING_SECONDS)}},
+                {"$set": claim}
+            )
+            if reclaimed:
+                return None
+        self.check(existing, scope, fingerprint)
+        self.remember(key, existing)
+        return existing["response"]
+
+    async def complete(self, key: str, response: dict):
+        entry = await idempotency_collection.find_one_and_update(
+            {"key": key}, {"$set": {"status": "done", "response": response}}, return_document=ReturnDocument.AFTER
+        )
+        if entry:
+            self.remember(key, entry)
+
+    async def release(self, key: str):
+        await idempotency_collection.delete_one({"key": key, "status": "pending"})
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.responses)}
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_CACHE_SIZE)
+
+async def idempotent(key: Optional[str], scope: str, request: BaseModel, handler):
+    """Runs `handler()` once per Idempotency-Key; retries get the stored response."""
+    if not key:
+        return await handler()
+    fingerprint = hashlib.sha256(json.dumps(jsonable_encoder(request), sort_keys=True).encode()).hexdigest()
+    stored = await idempotency_store.begin(key, scope, fingerprint)
+    if stored is not None:
+        return stored
+    try:
+        result = await handler()
+    except:
+        # Failed requests leave nothing behind, so the client may retry them
+        await idempotency_store.release(key)
+        raise
+    await idempotency_store.complete(key, jsonable_encoder(result))
+    return result
+
+sale_journal = SaleJournal(SALES_JOURNAL_PATH, SALES_FLUSH_INTERVAL_MS / 1000, SALES_FLUSH_BATCH) if SALES_INGEST_MODE == "journal" else None
+
+class RecentSales:
+    """Ring buffer of the sales this process recorded most recently.
+
+    Each entry is an undo snapshot: the sale id, its timestamp and the
+    (product_id, quantity, bottle_taken) lines needed to revert it, so undo
+    never re-reads the sale. The same snapshot is stored in undo_log, which
+    is what `claim()` deletes to make sure a sale is only undone once.
+    """
+
+    def __init__(self, size: int, shared: bool):
+        self.entries = deque(maxlen=size)
+        self.shared = shared
+
+    def push(self, entry: dict):
+        self.entries.append(entry)
+
+    def discard(self, sale_id: str):
+        for entry in self.entries:
+            if entry["sale_id"] == sale_id:
+                self.entries.remove(entry)
+                break
+
+    async def claim(self, since: datetime) -> Optional[dict]:
+        if not self.shared:
+            while self.entries:
+                entry = self.entries.pop()
+                if entry["timestamp"] < since:
+                    # Everything older is outside the window as well
+                    self.entries.clear()
+                    break
+                result = await undo_log_collection.delete_one({"sale_id": entry["sale_id"]})
+                if result.deleted_count:
+                    return entry
+        # Shared scope, or nothing left in this process (e.g. after a restart)
+        entry = await undo_log_collection.find_one_and_delete(
+            {"timestamp": {"$gte": since}},
+            sort=[("timestamp", -1)]
+        )
+        if entry:
+            self.discard(entry["sale_id"])
+        return entry
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "scope": "shared" if self.shared else "process"}
+
+recent_sales = RecentSales(UNDO_BUFFER_SIZE, UNDO_SCOPE == "shared")
+
+def undo_entry(sale_record: dict) -> dict:
+    # What undo needs to revert a single or multi sale, without the sale document
+    return {
+        "sale_id": str(sale_record["_id"]),
+        "timestamp": sale_record["timestamp"],
+        # UTC, for the TTL index; the window check uses the local timestamp
+        "created_at": datetime.now(timezone.utc),
+        "sold_by": sale_record["sold_by"],
+        "payment_method": sale_record["payment_method"],
+        "items": [
+            {
+                "product_id": item["product_id"],
+                "quantity": item["quantity"],
+                "total_amount": item["total_amount"],
+                "bottle_taken": item["bottle_taken"]
+            }
+            for item in sale_record.get("items", [sale_record])
+        ]
+    }
+
+def index_name(keys: list) -> str:
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+async def ensure_index(collection_name: str, keys: list, options: dict, existing: dict, report: dict):
+    name = index_name(keys)
+    current = existing.get(name)
+    if current is None:
+        try:
+            await db[collection_name].create_index(keys, name=name, **options)
+            report["created"].append(f"{collection_name}.{name}")
+        except OperationFailure as e:
+            report["failed"].append(f"{collection_name}.{name}: {e}")
+        return
+    for option in ("unique", "partialFilterExpression", "expireAfterSeconds"):
+        if current.get(option) == options.get(option):
+            continue
+        if option == "expireAfterSeconds" and options.get(option) is None:
+            # A TTL can't be removed in place, so the index is rebuilt without it
+            try:
+                await db[collection_name].drop_index(name)
+                await db[collection_name].create_index(keys, name=name, **options)
+                report["updated"].append(f"{collection_name}.{name}: TTL removed")
+            except OperationFailure as e:
+                report["failed"].append(f"{collection_name}.{name}: {e}")
+            return
+        if option == "expireAfterSeconds":
+            # TTLs can be changed in place
+            try:
+                await db.command("collMod", collection_name, index={"name": name, "expireAfterSeconds": options[option]})
+                report["updated"].append(f"{collection_name}.{name}: expireAfterSeconds={options[option]}")
+            except OperationFailure as e:
+                report["failed"].append(f"{collection_name}.{name}: {e}")
+            continue
+        report["drift"].append(f"{collection_name}.{name}: {option} is {current.get(option)!r}, expected {options.get(option)!r}")
+
+async def ensure_indexes(settings: dict) -> dict:
+    started = time.perf_counter()
+    registry = index_registry(settings)
+    report = {"created": [], "updated": [], "drift": [], "unmanaged": [], "failed": []}
+    for collection_name in sorted({spec[0] for spec in registry}):
+        existing = await db[collection_name].index_information()
+        specs = [spec for spec in registry if spec[0] == collection_name]
+        await asyncio.gather(*(ensure_index(c, keys, options, existing, report) for c, keys, options in specs))
+        managed = {index_name(keys) for _, keys, _ in specs}
+        report["unmanaged"].extend(f"{collection_name}.{name}" for name in existing if name != "_id_" and name not in managed)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    print(f"Indexes verified in {elapsed_ms:.0f} ms: {len(report['created'])} created, {len(report['updated'])} updated, "
+          f"{len(report['drift'])} drifted, {len(report['unmanaged'])} unmanaged, {len(report['failed'])} failed")
+    for kind in ("drift", "unmanaged", "failed"):
+        for entry in report[kind]:
+            print(f"  index {kind}: {entry}")
+    return report
+
+async def watch_settings():
+    try:
+        async with settings_collection.watch() as stream:
+            async for _ in stream:
+                settings_cache.invalidate()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Settings change stream unavailable, relying on TTL: {e}")
+
+def b64url_encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def b64url_decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def token_signature(body: str, settings: dict) -> str:
+    secret = (TOKEN_SECRET or settings["token_secret"]).encode()
+    return b64url_encode(hmac.new(secret, body.encode(), hashlib.sha256).digest())
+
+def issue_token(settings: dict) -> dict:
+    expires_at = int(time.time() + TOKEN_TTL_HOURS * 3600)
+    payload = {"exp": expires_at, "epoch": settings.get("token_epoch", 0)}
+    body = b64url_encode(json.dumps(payload, separators=(",", ":")).encode())
+    return {"token": f"{body}.{token_signature(body, settings)}", "expires_at": expires_at}
+
+def token_payload(token: str, settings: dict) -> Optional[dict]:
+    # Tokens are "<payload>.<hmac>"; returns the payload of a genuine, unexpired token
+    body, _, signature = token.partition(".")
+    # compare_digest only accepts ASCII str, so compare bytes to reject anything else with a 401
+    if not hmac.compare_digest(signature.encode(), token_signature(body, settings).encode()):
+        return None
+    try:
+        payload = json.loads(b64url_decode(body))
+    except:
+        return None
+    return payload if payload.get("exp", 0) > time.time() else None
+
+def token_is_valid(token: str, settings: dict) -> bool:
+    # Bumping token_epoch revokes every token issued before
+    payload = token_payload(token, settings)
+    return payload is not None and payload.get("epoch") == settings.get("token_epoch", 0)
+
+async def watch_catalog():
+    try:
+        async with products_collection.watch(full_document="updateLookup") as stream:
+            async for change in stream:
+                product_id = str(change["documentKey"]["_id"])
+                if change["operationType"] == "delete":
+                    product_catalog.remove(product_id)
+                    barcode_index.discard(product_id)
+                elif change.get("fullDocument"):
+                    product = change["fullDocument"]
+                    if stock_counters and product_catalog.get(product_id):
+                        # products.quantity lacks unfolded counter decrements; the catalog has them
+                        product = {**product, "quantity": product_catalog.get(product_id)["quantity"]}
+                    product_catalog.put(product)
+                    barcode_index.set(product_id, product.get("barcode"))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Product change stream unavailable, catalog only sees local writes: {e}")
+
+async def detect_transaction_support() -> bool:
+    try:
+        hello = await db.command("hello")
+    except Exception:
+        return False
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+async def run_in_transaction(callback):
+    """Runs `callback(session)` inside a transaction, retrying transient write conflicts.
+
+    Without transaction support the callback gets `session=None` and is
+    responsible for compensating its own partial writes.
+    """
+    if not transactions_supported:
+        return await callback(None)
+    async with await client.start_session() as session:
+        return await session.with_transaction(callback)
+
+async def reserve_stock(quantities: dict, session=None) -> bool:
+    # Decrement every product only if each one still has enough stock
+    if session is not None:
+        result = await products_collection.bulk_write([
+            UpdateOne({"_id": ObjectId(product_id), "quantity": {"$gte": quantity}}, {"$inc": {"quantity": -quantity}})
+            for product_id, quantity in quantities.items()
+        ], ordered=False, session=session)
+        # Returning False makes the caller raise, which aborts the transaction
+        return result.modified_count == len(quantities)
     
-    provided_pin_hash = hash_pin(credentials.credentials)
-    if provided_pin_hash != stored_pin_hash:
+    # No transactions: decrement concurrently and hand back whatever succeeded if any failed
+    results = await asyncio.gather(*(
+        products_collection.find_one_and_update(
+            {"_id": ObjectId(product_id), "quantity": {"$gte": quantity}},
+            {"$inc": {"quantity": -quantity}}
+        )
+        for product_id, quantity in quantities.items()
+    ))
+    if all(results):
+        return True
+    await release_stock({product_id: quantity for (product_id, quantity), result in zip(quantities.items(), results) if result})
+    return False
+
+async def release_stock(quantities: dict, session=None):
+    if quantities:
+        await products_collection.bulk_write([
+            UpdateOne({"_id": ObjectId(product_id)}, {"$inc": {"quantity": quantity}})
+            for product_id, quantity in quantities.items()
+        ], ordered=False, session=session)
+
+def encode_cursor(values: dict) -> str:
+    return b64url_encode(json.dumps(values, separators=(",", ":")).encode())
+
+def decode_cursor(cursor: str, keys: tuple = ("id",)) -> dict:
+    # keys are the positions the endpoint reads; a cursor from another
+    # endpoint may lack them
+    try:
+        values = json.loads(b64url_decode(cursor))
+        if any(key not in values for key in keys):
+            raise ValueError("Cursor is missing a key")
+        if "t" in values:
+            values["t"] = datetime.fromisoformat(values["t"])
+        values["id"] = ObjectId(values["id"])
+        return values
+    except:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def verify_pin(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    settings = await settings_cache.get()
+    payload = token_payload(credentials.credentials, settings)
+    if payload and payload.get("epoch", 0) > settings.get("token_epoch", 0):
+        # Issued after a PIN change on another worker: this worker's cached
+        # settings are behind, so reload them rather than reject the new token
+        settings_cache.invalidate()
+        settings = await settings_cache.get()
+    if not token_is_valid(credentials.credentials, settings):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid PIN"
+            detail="Invalid or expired token"
         )
     return True
 
 # Authentication endpoints
 @app.post("/auth/login")
 async def login(auth: PinAuth = Body(...)):
-    settings = await settings_collection.find_one({})
-    if not settings or "pin" not in settings:
-        # Initialize default PIN if not set
-        default_pin_hash = hash_pin("1234")
-        await settings_collection.insert_one({"pin": default_pin_hash, "low_stock_threshold": 5})
-        stored_pin_hash = default_pin_hash
-    else:
-        stored_pin_hash = settings["pin"]
-    
+    settings = await settings_cache.get()
     provided_pin_hash = hash_pin(auth.pin)
-    if provided_pin_hash != stored_pin_hash:
+    if provided_pin_hash != settings["pin"]:
         raise HTTPException(status_code=401, detail="Invalid PIN")
     
-    return {"message": "Authentication successful", "token": auth.pin}
+    return {"message": "Authentication successful", **issue_token(settings)}
 
 @app.post("/auth/change-pin")
 async def change_pin(old_pin: str, new_pin: str, _: bool = Depends(verify_pin)):
     if len(new_pin) != 4 or not new_pin.isdigit():
         raise HTTPException(status_code=400, detail="PIN must be 4 digits")
     
+    settings = await settings_cache.get()
+    if hash_pin(old_pin) != settings["pin"]:
+        raise HTTPException(status_code=401, detail="Invalid PIN")
+    
+    # Bumping the epoch revokes every token issued under the old PIN
     new_pin_hash = hash_pin(new_pin)
     await settings_collection.update_one(
         {},
-        {"$set": {"pin": new_pin_hash}},
+        {"$set": {"pin": new_pin_hash}, "$inc": {"token_epoch": 1}},
         upsert=True
     )
-    return {"message": "PIN changed successfully"}
+    settings_cache.invalidate()
+    settings = await settings_cache.get()
+    return {"message": "PIN changed successfully", **issue_token(settings)}
+
+# Inventory ledger: every stock change is also appended as a movement
+def movement(product_id: str, kind: str, delta: int, timestamp: datetime, sale_id: Optional[str] = None) -> dict:
+    record = {"product_id": product_id, "kind": kind, "delta": delta, "timestamp": timestamp}
+    if sale_id:
+        record["sale_id"] = sale_id
+    return record
+
+async def record_movements(movements: list, session=None):
+    if movements:
+        await inventory_ledger_collection.insert_many(movements, ordered=False, session=session)
+
+async def take_inventory_snapshots():
+    # Each snapshot is the previous one plus the ledger since, so snapshots and
+    # ledger always agree; products without one start from their current stock
+    now = datetime.now()
+    # Every worker checks at startup and on each tick; the first to claim a
+    # due interval takes the snapshots
+    claim = await settings_collection.update_one(
+        {"$or": [
+            {"inventory_snapshot_at": {"$exists": False}},
+            {"inventory_snapshot_at": {"$lte": now - timedelta(hours=INVENTORY_SNAPSHOT_HOURS)}}
+        ]},
+        {"$set": {"inventory_snapshot_at": now}}
+    )
+    if not claim.modified_count:
+        return
+    latest = {}
+    async for snapshot in inventory_snapshots_collection.aggregate([
+        {"$sort": {"product_id": 1, "timestamp": -1}},
+        {"$group": {"_id": "$product_id", "quantity": {"$first": "$quantity"}, "timestamp": {"$first": "$timestamp"}}}
+    ]):
+        latest[snapshot["_id"]] = snapshot
+    since = min((snapshot["timestamp"] for snapshot in latest.values()), default=now)
+    deltas = {}
+    async for entry in inventory_ledger_collection.find(
+        {"timestamp": {"$gt": since, "$lte": now}}, {"product_id": 1, "delta": 1, "timestamp": 1}
+    ):
+        previous = latest.get(entry["product_id"])
+        if previous and entry["timestamp"] > previous["timestamp"]:
+            deltas[entry["product_id"]] = deltas.get(entry["product_id"], 0) + entry["delta"]
+    snapshots = []
+    for product in product_catalog.all():
+        product_id = str(product["_id"])
+        previous = latest.get(product_id)
+        quantity = previous["quantity"] + deltas.get(product_id, 0) if previous else product["quantity"]
+        snapshots.append({"product_id": product_id, "quantity": quantity, "timestamp": now})
+    if snapshots:
+        await inventory_snapshots_collection.insert_many(snapshots)
+    print(f"Took {len(snapshots)} inventory snapshots")
+
+async def run_inventory_snapshots():
+    # Processes restart far more often than the snapshot interval, so wake
+    # up at least hourly and let the claim decide whether a snapshot is due
+    while True:
+        await asyncio.sleep(min(INVENTORY_SNAPSHOT_HOURS * 3600, 3600))
+        try:
+            await take_inventory_snapshots()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Inventory snapshot failed: {e}")
 
 # Product endpoints
 @app.post("/products", response_model=ProductResponse)
 async def add_product(product: Product, _: bool = Depends(verify_pin)):
     # Check if product already exists
-    existing = await products_collection.find_one({"name": product.name})
-    if existing:
+    if product_catalog.find_by_name(product.name):
         raise HTTPException(status_code=400, detail="Product already exists")
     
     product_dict = product.dict()
-    result = await products_collection.insert_one(product_dict)
+    product_dict["barcode"] = normalize_barcode(product.barcode)
+    if product_dict["barcode"] and barcode_index.get(product_dict["barcode"]):
+        raise HTTPException(status_code=400, detail="Barcode already assigned to another product")
+    try:
+        result = await products_collection.insert_one(product_dict)
+    except DuplicateKeyError as e:
+        if "barcode" in (e.details or {}).get("keyPattern", {}):
+            raise HTTPException(status_code=400, detail="Barcode already assigned to another product")
+        raise HTTPException(status_code=400, detail="Product already exists")
+    barcode_index.set(str(result.inserted_id), product_dict["barcode"])
     
     # Initialize bottle tracking if product is bottled
     if product.is_bottled:
@@ -219,23 +1353,69 @@ async def add_product(product: Product, _: bool = Depends(verify_pin)):
             "bottles_returned": 0
         })
     
+    if product.quantity:
+        await record_movements([movement(str(result.inserted_id), "restock", product.quantity, datetime.now())])
+    
     product_dict["_id"] = result.inserted_id
+    product_catalog.put(product_dict)
     return product_dict_to_response(product_dict)
 
 @app.get("/products", response_model=List[ProductResponse])
-async def get_products(_: bool = Depends(verify_pin)):
-    products = []
-    async for product in products_collection.find():
-        products.append(product_dict_to_response(product))
-    return products
+async def get_products(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    _: bool = Depends(verify_pin)
+):
+    selected = sparse_fields(fields, ProductResponse)
+    if limit is None and cursor is None:
+        etag = product_catalog.etag
+        if selected:
+            # Each selection is its own representation, so it gets its own ETag
+            etag = f'{etag[:-1]}-{hashlib.sha1(",".join(selected).encode()).hexdigest()[:8]}"'
+        if if_none_match and (if_none_match.strip() == "*" or etag in if_none_match):
+            return Response(status_code=304, headers={"ETag": etag})
+        # no-cache lets browsers keep the body but revalidate it with If-None-Match every time
+        return Response(content=product_catalog.payload(selected), media_type="application/json", headers={"ETag": etag, "Cache-Control": "no-cache"})
+    
+    # Keyset page ordered by _id (ObjectId hex strings sort in creation order)
+    limit = limit or MAX_PAGE_SIZE
+    after = str(decode_cursor(cursor)["id"]) if cursor else ""
+    product_ids = sorted(product_id for product_id in product_catalog.products if product_id > after)
+    page = product_ids[:limit]
+    headers = {"X-Next-Cursor": encode_cursor({"id": page[-1]})} if len(product_ids) > limit else {}
+    rows = [product_row(product_catalog.get(product_id)) for product_id in page]
+    return FastJSONResponse(trim_fields(rows, selected), headers=headers)
+
+@app.get("/products/barcode/{code}", response_model=ProductResponse)
+async def get_product_by_barcode(code: str, _: bool = Depends(verify_pin)):
+    code = normalize_barcode(code)
+    if code is None:
+        # A blank code would match every product without a barcode
+        raise HTTPException(status_code=404, detail="Product not found")
+    product_id = barcode_index.get(code)
+    if product_id:
+        product = product_catalog.get(product_id)
+        if product and product.get("barcode") == code:
+            barcode_index.hits += 1
+            return product_dict_to_response(product)
+        barcode_index.discard(product_id)
+    
+    # Not indexed in this process (or stale): ask Mongo and remember the answer
+    barcode_index.misses += 1
+    product = await products_collection.find_one({"barcode": code})
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    barcode_index.set(str(product["_id"]), code)
+    return product_dict_to_response(product)
 
 @app.get("/products/{product_id}", response_model=ProductResponse)
 async def get_product(product_id: str, _: bool = Depends(verify_pin)):
-    try:
-        product = await products_collection.find_one({"_id": ObjectId(product_id)})
-    except:
+    if not ObjectId.is_valid(product_id):
         raise HTTPException(status_code=400, detail="Invalid product ID")
     
+    product = product_catalog.get(product_id)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
@@ -249,20 +1429,141 @@ async def update_product(product_id: str, product_update: ProductUpdate, _: bool
         raise HTTPException(status_code=400, detail="Invalid product ID")
     
     update_data = {k: v for k, v in product_update.dict().items() if v is not None}
+    if "barcode" in update_data:
+        update_data["barcode"] = normalize_barcode(update_data["barcode"])
+        owner = barcode_index.get(update_data["barcode"])
+        if owner and owner != product_id:
+            raise HTTPException(status_code=400, detail="Barcode already assigned to another product")
     if not update_data:
         raise HTTPException(status_code=400, detail="No data to update")
     
-    result = await products_collection.update_one(
-        {"_id": object_id},
-        {"$set": update_data}
-    )
+    if stock_counters:
+        # products.quantity must hold the full stock before it is overwritten or cached
+        await stock_counters.fold([product_id])
     
-    if result.matched_count == 0:
+    try:
+        previous_product = await products_collection.find_one_and_update(
+            {"_id": object_id},
+            {"$set": update_data},
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError as e:
+        if "barcode" in (e.details or {}).get("keyPattern", {}):
+            raise HTTPException(status_code=400, detail="Barcode already assigned to another product")
+        raise HTTPException(status_code=400, detail="Product already exists")
+    
+    if not previous_product:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    updated_product = await products_collection.find_one({"_id": object_id})
+    updated_product = {**previous_product, **update_data}
+    if updated_product["quantity"] != previous_product["quantity"]:
+        await record_movements([movement(product_id, "adjustment", updated_product["quantity"] - previous_product["quantity"], datetime.now())])
+    
+    if stock_counters:
+        # Sales since the fold only live in counter slots and the catalog, so
+        # products.quantity is behind the real stock and must not be cached
+        if "quantity" in update_data:
+            unfolded = 0
+            async for slot in stock_counters_collection.find({"product_id": product_id}, {"delta": 1}):
+                unfolded += slot["delta"]
+            updated_product["quantity"] = update_data["quantity"] + unfolded
+        elif product_catalog.get(product_id):
+            updated_product["quantity"] = product_catalog.get(product_id)["quantity"]
+    
+    barcode_index.set(product_id, updated_product.get("barcode"))
+    product_catalog.put(updated_product)
     return product_dict_to_response(updated_product)
 
+@app.post("/products/{product_id}/restock", response_model=ProductResponse)
+async def restock_product(product_id: str, restock: Restock, _: bool = Depends(verify_pin)):
+    if not ObjectId.is_valid(product_id):
+        raise HTTPException(status_code=400, detail="Invalid product ID")
+    
+    product = await products_collection.find_one_and_update(
+        {"_id": ObjectId(product_id)},
+        {"$inc": {"quantity": restock.quantity}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    
+    await record_movements([movement(product_id, "restock", restock.quantity, datetime.now())])
+    if stock_counters:
+        # products.quantity doesn't include unfolded counter deltas
+        product_catalog.adjust_quantity(product_id, restock.quantity)
+        product = product_catalog.get(product_id)
+    else:
+        product_catalog.put(product)
+    return product_dict_to_response(product)
+
+@app.get("/inventory/{product_id}/movements", response_model=List[StockMovement])
+async def get_stock_movements(
+    product_id: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    limit: int = Query(DEFAULT_SALES_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    response: Response = None,
+    _: bool = Depends(verify_pin)
+):
+    filter_dict = {"product_id": product_id}
+    try:
+        date_filter = {}
+        if start_date:
+            date_filter["$gte"] = datetime.fromisoformat(start_date)
+        if end_date:
+            date_filter["$lte"] = datetime.fromisoformat(end_date)
+    except:
+        raise HTTPException(status_code=400, detail="Invalid date format")
+    if date_filter:
+        filter_dict["timestamp"] = date_filter
+    if cursor:
+        position = decode_cursor(cursor, ("t", "id"))
+        filter_dict["$or"] = [
+            {"timestamp": {"$lt": position["t"]}},
+            {"timestamp": position["t"], "_id": {"$lt": position["id"]}}
+        ]
+    
+    documents = await inventory_ledger_collection.find(filter_dict).sort([("timestamp", -1), ("_id", -1)]).limit(limit + 1).to_list(limit + 1)
+    if len(documents) > limit:
+        documents = documents[:limit]
+        last = documents[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor({"t": last["timestamp"].isoformat(), "id": str(last["_id"])})
+    return [StockMovement(id=str(entry["_id"]), **entry) for entry in documents]
+
+@app.get("/inventory/{product_id}/stock")
+async def get_stock_at(product_id: str, at: str, _: bool = Depends(verify_pin)):
+    try:
+        at_time = datetime.fromisoformat(at)
+    except:
+        raise HTTPException(status_code=400, detail="Invalid date format")
+    product = product_catalog.get(product_id)
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    
+    # Start from the nearest snapshot before `at` and roll the ledger forward,
+    # or from the next snapshot (or current stock) and roll it back
+    snapshot = await inventory_snapshots_collection.find_one(
+        {"product_id": product_id, "timestamp": {"$lte": at_time}}, sort=[("timestamp", -1)]
+    )
+    if snapshot:
+        window, base, sign = {"$gt": snapshot["timestamp"], "$lte": at_time}, snapshot["quantity"], 1
+    else:
+        snapshot = await inventory_snapshots_collection.find_one(
+            {"product_id": product_id, "timestamp": {"$gt": at_time}}, sort=[("timestamp", 1)]
+        )
+        if snapshot:
+            window, base = {"$gt": at_time, "$lte": snapshot["timestamp"]}, snapshot["quantity"]
+        else:
+            window, base = {"$gt": at_time}, product["quantity"]
+        sign = -1
+    result = await inventory_ledger_collection.aggregate([
+        {"$match": {"product_id": product_id, "timestamp": window}},
+        {"$group": {"_id": None, "delta": {"$sum": "$delta"}}}
+    ]).to_list(1)
+    delta = result[0]["delta"] if result else 0
+    return {"product_id": product_id, "at": at_time, "quantity": base + sign * delta}
+
 @app.delete("/products/{product_id}")
 async def delete_product(product_id: str, _: bool = Depends(verify_pin)):
     try:
@@ -274,27 +1575,104 @@ async def delete_product(product_id: str, _: bool = Depends(verify_pin)):
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
     
+    barcode_index.discard(product_id)
+    product_catalog.remove(product_id)
+    
     # Clean up bottle tracking
     await bottles_collection.delete_one({"product_id": product_id})
+    if stock_counters:
+        await stock_counters_collection.delete_many({"product_id": product_id})
     
     return {"message": "Product deleted successfully"}
 
 # Sales endpoints
-@app.post("/sales", response_model=SaleResponse)
-async def record_sale(sale: Sale, _: bool = Depends(verify_pin)):
+def sale_line(product: dict, quantity: int, bottle_taken: bool) -> dict:
+    # Priced sale line for a product snapshot, as stored in multi-sale items
+    return {
+        "product_id": str(product["_id"]),
+        "product_name": product["name"],
+        "quantity": quantity,
+        "unit_price": product["unit_price"],
+        "total_amount": product["unit_price"] * quantity,
+        "bottle_taken": bottle_taken if product["is_bottled"] else False
+    }
+
+def sale_document(sale_record: dict, timeseries: bool = TIMESERIES_SALES) -> dict:
+    # The sale as stored: lowercased copies of the searchable names, so GET
+    # /sales can match them exactly or by prefix on an index instead of
+    # scanning with $regex, and the time-series metaField when enabled
+    document = {**sale_record, "sold_by_lc": sale_record["sold_by"].lower()}
+    if "items" in sale_record:
+        document["items"] = [{**item, "product_name_lc": item["product_name"].lower()} for item in sale_record["items"]]
+    else:
+        document["product_name_lc"] = sale_record["product_name"].lower()
+    if timeseries:
+        # Buckets group a seller's sales per payment method; the fields stay
+        # at the top level too so every query reads the same in both modes
+        document["meta"] = {"sold_by": sale_record["sold_by"], "payment_method": sale_record["payment_method"]}
+    return document
+
+async def backfill_search_fields():
+    # Sales stored before the lowercase fields existed get them once
+    updates = []
+    async for sale in sales_collection.find({"sold_by_lc": {"$exists": False}}):
+        search_fields = {key: value for key, value in sale_document(sale, timeseries=False).items() if key in ("sold_by_lc", "product_name_lc", "items")}
+        updates.append(UpdateOne({"_id": sale["_id"]}, {"$set": search_fields}))
+        if len(updates) == 1000:
+            await sales_collection.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        await sales_collection.bulk_write(updates, ordered=False)
+
+async def compensate_sale(sale_record: dict, applied: list):
+    # Reverts a single sale whose insert failed: stock plus the side effects that landed
+    writes = [release_stock({sale_record["product_id"]: sale_record["quantity"]})]
+    if "bottles" in applied:
+        writes.append(bottles_collection.update_one(
+            {"product_id": sale_record["product_id"]},
+            {"$inc": {"bottles_taken": -sale_record["quantity"]}}
+        ))
+    if "ledger" in applied:
+        writes.append(inventory_ledger_collection.delete_many({"sale_id": str(sale_record["_id"])}))
+    if "undo_log" in applied:
+        writes.append(undo_log_collection.delete_one({"sale_id": str(sale_record["_id"])}))
+    if "daily_stats" in applied:
+        writes.append(apply_rollups([sale_record], -1))
+    await asyncio.gather(*writes)
+    product_catalog.adjust_quantity(sale_record["product_id"], sale_record["quantity"])
+
+async def create_sale(sale: Sale) -> SaleResponse:
     try:
         product_id = ObjectId(sale.product_id)
     except:
         raise HTTPException(status_code=400, detail="Invalid product ID")
     
-    # Get product details
-    product = await products_collection.find_one({"_id": product_id})
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    # Check stock availability
-    if product["quantity"] < sale.quantity:
-        raise HTTPException(status_code=400, detail="Insufficient stock")
+    if stock_counters:
+        # Reserve against the in-process total before awaiting, then record the
+        # decrement on a random counter slot
+        product = product_catalog.get(sale.product_id)
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        if product["quantity"] < sale.quantity:
+            raise HTTPException(status_code=400, detail="Insufficient stock")
+        product_catalog.adjust_quantity(sale.product_id, -sale.quantity)
+        try:
+            await stock_counters.take(sale.product_id, sale.quantity)
+        except:
+            product_catalog.adjust_quantity(sale.product_id, sale.quantity)
+            raise
+    else:
+        # Check and decrement stock in one round trip so concurrent tills can't oversell
+        product = await products_collection.find_one_and_update(
+            {"_id": product_id, "quantity": {"$gte": sale.quantity}},
+            {"$inc": {"quantity": -sale.quantity}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not product:
+            if product_catalog.get(sale.product_id) is None:
+                raise HTTPException(status_code=404, detail="Product not found")
+            raise HTTPException(status_code=400, detail="Insufficient stock")
+        product_catalog.put(product)
     
     # Calculate total amount
     total_amount = product["unit_price"] * sale.quantity
@@ -309,94 +1687,395 @@ async def record_sale(sale: Sale, _: bool = Depends(verify_pin)):
         "bottle_taken": sale.bottle_taken if product["is_bottled"] else False,
         "sold_by": sale.sold_by,
         "payment_method": sale.payment_method,
+        "customer_id": sale.customer_id,
         "timestamp": datetime.now()
     }
     
-    # Insert sale record
-    sale_result = await sales_collection.insert_one(sale_record)
-    
-    # Update product quantity
-    await products_collection.update_one(
-        {"_id": product_id},
-        {"$inc": {"quantity": -sale.quantity}}
-    )
-    
-    # Update bottle tracking if applicable
-    if product["is_bottled"] and sale.bottle_taken:
-        await bottles_collection.update_one(
+    # Stock is reserved, so the remaining writes are independent and go out
+    # together. The sale insert is the commit point: if it fails, stock and any
+    # side effect that landed are reverted. Bottle and undo-log writes that fail
+    # after the sale is stored are logged rather than failing the request.
+    sale_record["_id"] = ObjectId()
+    side_effects = {}
+    if sale_record["bottle_taken"]:
+        side_effects["bottles"] = bottles_collection.update_one(
             {"product_id": sale.product_id},
             {"$inc": {"bottles_taken": sale.quantity}},
             upsert=True
         )
+    side_effects["ledger"] = inventory_ledger_collection.insert_one(
+        movement(sale.product_id, "sale", -sale.quantity, sale_record["timestamp"], str(sale_record["_id"]))
+    )
+    side_effects["daily_stats"] = apply_rollups([sale_record])
+    # Expired undo entries are removed by the TTL index
+    side_effects["undo_log"] = undo_log_collection.insert_one(undo_entry(sale_record))
+    document = sale_document(sale_record)
+    store_sale = sale_journal.append(document) if sale_journal else sales_collection.insert_one(document)
+    sale_result, *effect_results = await asyncio.gather(store_sale, *side_effects.values(), return_exceptions=True)
+    failed = {name: result for name, result in zip(side_effects, effect_results) if isinstance(result, Exception)}
+    if isinstance(sale_result, Exception):
+        await compensate_sale(sale_record, [name for name in side_effects if name not in failed])
+        raise sale_result
+    for name, error in failed.items():
+        print(f"Sale {sale_record['_id']}: {name} write failed: {error}")
     
-    # Add to undo log
-    await undo_log_collection.insert_one({
-        "sale_id": str(sale_result.inserted_id),
-        "timestamp": datetime.now()
-    })
-    
-    # Clean old undo logs (older than 5 minutes)
-    five_minutes_ago = datetime.now() - timedelta(minutes=5)
-    await undo_log_collection.delete_many({"timestamp": {"$lt": five_minutes_ago}})
-    
-    sale_record["id"] = str(sale_result.inserted_id)
+    if "undo_log" not in failed:
+        recent_sales.push(undo_entry(sale_record))
+    sale_record["id"] = str(sale_record["_id"])
     return SaleResponse(**sale_record)
 
-@app.post("/sales/multi", response_model=MultiSaleResponse)
-async def record_multi_sale(sale: MultiSale, _: bool = Depends(verify_pin)):
-    total_amount = 0
-    sale_items = []
+@app.post("/sales", response_model=SaleResponse)
+async def record_sale(
+    sale: Sale,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    _: bool = Depends(verify_pin)
+):
+    return await idempotent(idempotency_key, "/sales", sale, lambda: create_sale(sale))
+
+async def create_multi_sale(sale: MultiSale) -> MultiSaleResponse:
+    if not sale.items:
+        raise HTTPException(status_code=400, detail="No items in sale")
+    
+    # Repeated products are combined so each gets a single conditional update
+    quantities = {}
     for item in sale.items:
+        if not ObjectId.is_valid(item.product_id):
+            raise HTTPException(status_code=400, detail="Invalid product ID")
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    
+    async def apply(session):
+        products = {}
+        async for product in products_collection.find({"_id": {"$in": [ObjectId(product_id) for product_id in quantities]}}, session=session):
+            products[str(product["_id"])] = product
+        for product_id, quantity in quantities.items():
+            if product_id not in products:
+                raise HTTPException(status_code=404, detail=f"Product not found: {product_id}")
+            if products[product_id]["quantity"] < quantity:
+                raise HTTPException(status_code=400, detail=f"Insufficient stock for {products[product_id]['name']}")
+        
+        total_amount = 0
+        sale_items = []
+        bottles_taken = {}
+        for item in sale.items:
+            sale_item = sale_line(products[item.product_id], item.quantity, item.bottle_taken)
+            total_amount += sale_item["total_amount"]
+            sale_items.append(sale_item)
+            if sale_item["bottle_taken"]:
+                bottles_taken[item.product_id] = bottles_taken.get(item.product_id, 0) + item.quantity
+        sale_record = {
+            "_id": ObjectId(),
+            "items": sale_items,
+            "sold_by": sale.sold_by,
+            "payment_method": sale.payment_method,
+            "customer_id": sale.customer_id,
+            "total_amount": total_amount,
+            "timestamp": datetime.now()
+        }
+        
+        if not await reserve_stock(quantities, session):
+            raise HTTPException(status_code=400, detail="Insufficient stock")
+        rolled_up = False
         try:
-            product_id = ObjectId(item.product_id)
+            if bottles_taken:
+                await bottles_collection.bulk_write([
+                    UpdateOne({"product_id": product_id}, {"$inc": {"bottles_taken": count}}, upsert=True)
+                    for product_id, count in bottles_taken.items()
+                ], ordered=False, session=session)
+            await record_movements([
+                movement(product_id, "sale", -quantity, sale_record["timestamp"], str(sale_record["_id"]))
+                for product_id, quantity in quantities.items()
+            ], session)
+            await undo_log_collection.insert_one(undo_entry(sale_record), session=session)
+            await apply_rollups([sale_record], session=session)
+            rolled_up = True
+            await sales_collection.insert_one(sale_document(sale_record), session=session)
         except:
-            raise HTTPException(status_code=400, detail="Invalid product ID")
-        product = await products_collection.find_one({"_id": product_id})
-        if not product:
-            raise HTTPException(status_code=404, detail=f"Product not found: {item.product_id}")
-        if product["quantity"] < item.quantity:
-            raise HTTPException(status_code=400, detail=f"Insufficient stock for {product['name']}")
-        amount = product["unit_price"] * item.quantity
-        total_amount += amount
-        sale_items.append({
-            "product_id": item.product_id,
-            "product_name": product["name"],
-            "quantity": item.quantity,
-            "unit_price": product["unit_price"],
-            "total_amount": amount,
-            "bottle_taken": item.bottle_taken if product["is_bottled"] else False
-        })
-        # Update product quantity
-        await products_collection.update_one(
-            {"_id": product_id},
-            {"$inc": {"quantity": -item.quantity}}
-        )
-        # Update bottle tracking if applicable
-        if product["is_bottled"] and item.bottle_taken:
-            await bottles_collection.update_one(
-                {"product_id": item.product_id},
-                {"$inc": {"bottles_taken": item.quantity}},
-                upsert=True
-            )
-    sale_record = {
-        "items": sale_items,
-        "sold_by": sale.sold_by,
-        "payment_method": sale.payment_method,
-        "total_amount": total_amount,
-        "timestamp": datetime.now()
-    }
-    sale_result = await sales_collection.insert_one(sale_record)
-    sale_record["id"] = str(sale_result.inserted_id)
+            if session is None:
+                await release_stock(quantities)
+                await inventory_ledger_collection.delete_many({"sale_id": str(sale_record["_id"])})
+                await undo_log_collection.delete_one({"sale_id": str(sale_record["_id"])})
+                if rolled_up:
+                    await apply_rollups([sale_record], -1)
+                if bottles_taken:
+                    await bottles_collection.bulk_write([
+                        UpdateOne({"product_id": product_id}, {"$inc": {"bottles_taken": -count}})
+                        for product_id, count in bottles_taken.items()
+                    ], ordered=False)
+            raise
+        return sale_record
+    
+    if stock_counters:
+        # The catalog is the oversell check in this mode, as for single sales:
+        # reserve there before awaiting, then fold and write to Mongo
+        missing = next((product_id for product_id in quantities if product_catalog.get(product_id) is None), None)
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Product not found: {missing}")
+        if not product_catalog.reserve(quantities):
+            raise HTTPException(status_code=400, detail="Insufficient stock")
+        try:
+            await stock_counters.fold(quantities)
+            sale_record = await run_in_transaction(apply)
+        except:
+            product_catalog.release(quantities)
+            raise
+    else:
+        sale_record = await run_in_transaction(apply)
+        for product_id, quantity in quantities.items():
+            product_catalog.adjust_quantity(product_id, -quantity)
+    recent_sales.push(undo_entry(sale_record))
+    sale_record["id"] = str(sale_record["_id"])
     return MultiSaleResponse(**sale_record)
 
+@app.post("/sales/multi", response_model=MultiSaleResponse)
+async def record_multi_sale(
+    sale: MultiSale,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    _: bool = Depends(verify_pin)
+):
+    return await idempotent(idempotency_key, "/sales/multi", sale, lambda: create_multi_sale(sale))
+
+class StockConflict(Exception):
+    pass
+
+def local_naive(timestamp: datetime) -> datetime:
+    # Sales are stored with naive local timestamps like datetime.now()
+    return timestamp.astimezone().replace(tzinfo=None) if timestamp.tzinfo else timestamp
+
+@app.post("/sales/batch", response_model=List[BatchSaleResult])
+async def record_sales_batch(batch: SaleBatch, _: bool = Depends(verify_pin)):
+    results = [BatchSaleResult(index=i, client_ref=entry.client_ref, status="pending") for i, entry in enumerate(batch.sales)]
+    
+    # Normalize every entry to (product_id, quantity, bottle_taken) lines
+    lines = {}
+    for i, entry in enumerate(batch.sales):
+        if entry.items:
+            entry_lines = [(item.product_id, item.quantity, item.bottle_taken) for item in entry.items]
+        elif entry.product_id and entry.quantity:
+            entry_lines = [(entry.product_id, entry.quantity, entry.bottle_taken)]
+        else:
+            results[i].status, results[i].detail = "rejected", "Sale needs product_id and quantity, or items"
+            continue
+        if not all(ObjectId.is_valid(product_id) for product_id, _, _ in entry_lines):
+            results[i].status, results[i].detail = "rejected", "Invalid product ID"
+            continue
+        lines[i] = entry_lines
+    
+    # Sales uploaded before (or twice in this batch) are reported, not re-applied
+    first_index = {}
+    for i in list(lines):
+        ref = batch.sales[i].client_ref
+        if ref in first_index:
+            results[i].status, results[i].detail = "duplicate", f"Same client_ref as sale {first_index[ref]}"
+            del lines[i]
+        else:
+            first_index[ref] = i
+    async for existing in sales_collection.find({"client_ref": {"$in": list(first_index)}}, {"client_ref": 1}):
+        i = first_index[existing["client_ref"]]
+        results[i].status, results[i].id = "duplicate", str(existing["_id"])
+        lines.pop(i, None)
+    
+    # In counter mode the catalog is the oversell check, as for single sales:
+    # stock is taken from it in the same synchronous step that validates
+    reserved = {}
+    
+    async def apply(session):
+        # A retried transaction starts over, so hand back the last attempt's reservation
+        product_catalog.release(reserved)
+        reserved.clear()
+        
+        # Validate against the catalog in one pass, consuming stock in upload order
+        product_ids = {product_id for entry_lines in lines.values() for product_id, _, _ in entry_lines}
+        products = {}
+        async for product in products_collection.find({"_id": {"$in": [ObjectId(product_id) for product_id in product_ids]}}, session=session):
+            products[str(product["_id"])] = product
+        available = {product_id: product["quantity"] for product_id, product in products.items()}
+        if stock_counters:
+            # Unfolded counter decrements are only reflected in the catalog
+            available = {product_id: product_catalog.get(product_id)["quantity"] if product_catalog.get(product_id) else quantity for product_id, quantity in available.items()}
+        accepted, rejected = {}, {}
+        for i, entry_lines in lines.items():
+            needed = {}
+            for product_id, quantity, _ in entry_lines:
+                needed[product_id] = needed.get(product_id, 0) + quantity
+            missing = next((product_id for product_id in needed if product_id not in products), None)
+            short = next((product_id for product_id, quantity in needed.items() if product_id in products and available[product_id] < quantity), None)
+            if missing:
+                rejected[i] = f"Product not found: {missing}"
+            elif short:
+                rejected[i] = f"Insufficient stock for {products[short]['name']}"
+            else:
+                for product_id, quantity in needed.items():
+                    available[product_id] -= quantity
+                accepted[i] = entry_lines
+        
+        quantities, bottles_taken, documents = {}, {}, []
+        synced_at = datetime.now()
+        for i, entry_lines in accepted.items():
+            entry = batch.sales[i]
+            items = []
+            for product_id, quantity, bottle_taken in entry_lines:
+                item = sale_line(products[product_id], quantity, bottle_taken)
+                items.append(item)
+                quantities[product_id] = quantities.get(product_id, 0) + quantity
+                if item["bottle_taken"]:
+                    bottles_taken[product_id] = bottles_taken.get(product_id, 0) + quantity
+            document = items[0] if entry.product_id and not entry.items else {"items": items, "total_amount": sum(item["total_amount"] for item in items)}
+            documents.append({
+                "_id": ObjectId(),
+                **document,
+                "sold_by": entry.sold_by,
+                "payment_method": entry.payment_method,
+                "customer_id": entry.customer_id,
+                "client_ref": entry.client_ref,
+                "timestamp": local_naive(entry.timestamp),
+                "synced_at": synced_at
+            })
+        
+        if stock_counters:
+            product_catalog.reserve(quantities)
+            reserved.update(quantities)
+        if quantities and not await reserve_stock(quantities, session):
+            raise StockConflict()
+        rolled_up = False
+        try:
+            if bottles_taken:
+                await bottles_collection.bulk_write([
+                    UpdateOne({"product_id": product_id}, {"$inc": {"bottles_taken": count}}, upsert=True)
+                    for product_id, count in bottles_taken.items()
+                ], ordered=False, session=session)
+            # Stock changes at sync time, so movements use synced_at rather than the sale time
+            await record_movements([
+                movement(item["product_id"], "sale", -item["quantity"], synced_at, str(document["_id"]))
+                for document in documents for item in document.get("items", [document])
+            ], session)
+            # Rollups go to each sale's own day, not the sync day
+            await apply_rollups(documents, session=session)
+            rolled_up = True
+            if documents:
+                await sales_collection.insert_many([sale_document(document) for document in documents], ordered=False, session=session)
+        except:
+            if session is None:
+                # An unordered insert_many stores every sale it can before raising
+                await sales_collection.delete_many({"_id": {"$in": [document["_id"] for document in documents]}})
+                await release_stock(quantities)
+                await inventory_ledger_collection.delete_many({"sale_id": {"$in": [str(document["_id"]) for document in documents]}})
+                if rolled_up:
+                    await apply_rollups(documents, -1)
+                if bottles_taken:
+                    await bottles_collection.bulk_write([
+                        UpdateOne({"product_id": product_id}, {"$inc": {"bottles_taken": -count}})
+                        for product_id, count in bottles_taken.items()
+                    ], ordered=False)
+            raise
+        return accepted, rejected, documents, quantities
+    
+    if stock_counters:
+        await stock_counters.fold({product_id for entry_lines in lines.values() for product_id, _, _ in entry_lines})
+    
+    # Stock moved by other tills between validation and the conditional
+    # decrement: validate again against fresh stock
+    try:
+        for attempt in range(3):
+            try:
+                accepted, rejected, documents, quantities = await run_in_transaction(apply)
+                break
+            except StockConflict:
+                continue
+            except (DuplicateKeyError, BulkWriteError):
+                raise HTTPException(status_code=409, detail="Batch overlaps an upload in progress, retry")
+        else:
+            raise HTTPException(status_code=409, detail="Stock kept changing during sync, retry")
+    except:
+        product_catalog.release(reserved)
+        raise
+    
+    if not stock_counters:
+        for product_id, quantity in quantities.items():
+            product_catalog.adjust_quantity(product_id, -quantity)
+    for i, document in zip(accepted, documents):
+        results[i].status, results[i].id = "recorded", str(document["_id"])
+    for i, detail in rejected.items():
+        results[i].status, results[i].detail = "rejected", detail
+    return results
+
+SALE_EXPORT_FIELDS = list(SaleResponse.model_fields)
+
+def name_condition(value: str, match: str):
+    # Condition on a lowercase shadow field; an anchored, case-sensitive
+    # prefix regex is answered from the index
+    value = value.strip().lower()
+    return value if match == "exact" else {"$regex": "^" + re.escape(value)}
+
+def item_field(name: str) -> dict:
+    # After unwinding, a multi-sale row has the field under "items"; single
+    # sales have no items and keep it at the top level
+    return {"$ifNull": [f"$items.{name}", f"${name}"]}
+
+# Response fields of one sold product
+SALE_ROW_PROJECTION = {
+    "_id": 0,
+    "id": {"$toString": "$_id"},
+    "product_id": item_field("product_id"),
+    "product_name": item_field("product_name"),
+    "quantity": item_field("quantity"),
+    "unit_price": item_field("unit_price"),
+    "total_amount": item_field("total_amount"),
+    "bottle_taken": {"$ifNull": [item_field("bottle_taken"), False]},
+    "sold_by": 1,
+    "payment_method": 1,
+    "timestamp": 1
+}
+
+def sales_pipeline(filter_dict: dict, item_filter: Optional[dict], limit: Optional[int], fields: Optional[list] = None) -> list:
+    # Sales are matched and paged as whole documents (a multi-sale counts as
+    # one), then flattened to response rows on the server
+    pipeline = [{"$match": filter_dict}, {"$sort": {"timestamp": -1, "_id": -1}}]
+    if limit:
+        pipeline.append({"$limit": limit})
+    pipeline.append({"$unwind": {"path": "$items", "preserveNullAndEmptyArrays": True}})
+    if item_filter:
+        # Single sales already matched; keep only the matching multi-sale items
+        pipeline.append({"$match": {"$or": [{"items": {"$exists": False}}, item_filter]}})
+    projection = SALE_ROW_PROJECTION
+    if fields:
+        projection = {"_id": 0, **{name: SALE_ROW_PROJECTION[name] for name in fields}}
+    pipeline.append({"$project": projection})
+    return pipeline
+
+async def stream_sales(rows, format: str, fields: Optional[list] = None):
+    # Rows are written as they come off the aggregation cursor, so memory
+    # stays at one batch however much history is exported
+    fields = fields or SALE_EXPORT_FIELDS
+    if format == "csv":
+        buffer = StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=fields)
+        writer.writeheader()
+    async for row in rows:
+        row = {name: row.get(name) for name in fields}
+        if format == "csv":
+            if "timestamp" in row:
+                row["timestamp"] = row["timestamp"].isoformat()
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        else:
+            yield dump_json(row) + b"\n"
+
 @app.get("/sales", response_model=List[SaleResponse])
 async def get_sales(
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     product_name: Optional[str] = None,
     seller_name: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    match: str = Query("prefix", pattern="^(exact|prefix|regex)$"),
+    cursor: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson|csv)$"),
+    fields: Optional[str] = None,
     _: bool = Depends(verify_pin)
 ):
+    selected = sparse_fields(fields, SaleResponse)
     filter_dict = {}
 
     # Date range filter
@@ -414,86 +2093,203 @@ async def get_sales(
                 raise HTTPException(status_code=400, detail="Invalid end_date format")
         filter_dict["timestamp"] = date_filter
 
-    # Product name filter
+    # Product and seller filters match the lowercase fields exactly or by
+    # prefix, both of which use an index; regex scans and is opt-in
+    clauses = []
+    item_filter = None
     if product_name:
-        filter_dict["product_name"] = {"$regex": product_name, "$options": "i"}
-
-    # Seller name filter
+        if match == "regex":
+            condition = {"$regex": product_name, "$options": "i"}
+            clauses.append({"$or": [{"product_name": condition}, {"items.product_name": condition}]})
+            item_filter = {"items.product_name": condition}
+        else:
+            condition = name_condition(product_name, match)
+            clauses.append({"$or": [{"product_name_lc": condition}, {"items.product_name_lc": condition}]})
+            item_filter = {"items.product_name_lc": condition}
     if seller_name:
-        filter_dict["sold_by"] = {"$regex": seller_name, "$options": "i"}
-
-    sales = []
-    async for sale in sales_collection.find(filter_dict).sort("timestamp", -1):
-        if "items" in sale:
-            # Multi-sale: flatten each item
-            for item in sale["items"]:
-                sales.append(SaleResponse(
-                    id=str(sale["_id"]),
-                    product_id=item["product_id"],
-                    product_name=item["product_name"],
-                    quantity=item["quantity"],
-                    unit_price=item["unit_price"],
-                    total_amount=item["total_amount"],
-                    bottle_taken=item.get("bottle_taken", False),
-                    sold_by=sale["sold_by"],
-                    payment_method=sale["payment_method"],
-                    timestamp=sale["timestamp"]
-                ))
+        if match == "regex":
+            filter_dict["sold_by"] = {"$regex": seller_name, "$options": "i"}
         else:
-            sale["id"] = str(sale["_id"])
-            sales.append(SaleResponse(**sale))
-    return sales
+            filter_dict["sold_by_lc"] = name_condition(seller_name, match)
+
+    # Resume after the last sale of the previous page; a multi-sale counts as one
+    if cursor:
+        position = decode_cursor(cursor, ("t", "id"))
+        clauses.append({"$or": [
+            {"timestamp": {"$lt": position["t"]}},
+            {"timestamp": position["t"], "_id": {"$lt": position["id"]}}
+        ]})
+    if clauses:
+        filter_dict["$and"] = clauses
+
+    # ndjson and csv stream every matching sale (up to `limit` if given)
+    if format != "json":
+        rows = sales_collection.aggregate(sales_pipeline(filter_dict, item_filter, limit, selected))
+        media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+        return StreamingResponse(stream_sales(rows, format, selected), media_type=media_type)
+
+    # The page boundary needs each row's id and timestamp even when not selected
+    limit = limit or DEFAULT_SALES_PAGE_SIZE
+    projected = selected and list(dict.fromkeys(selected + ["id", "timestamp"]))
+    rows = await sales_collection.aggregate(sales_pipeline(filter_dict, item_filter, limit + 1, projected)).to_list(None)
+    # Rows of the (limit + 1)th sale only signal that another page exists
+    headers = {}
+    sale_ids = list(dict.fromkeys(row["id"] for row in rows))
+    if len(sale_ids) > limit:
+        rows = [row for row in rows if row["id"] != sale_ids[limit]]
+        last = rows[-1]
+        headers["X-Next-Cursor"] = encode_cursor({"t": last["timestamp"].isoformat(), "id": last["id"]})
+
+    return FastJSONResponse(trim_fields(rows, selected or SALE_EXPORT_FIELDS), headers=headers)
 
 @app.delete("/sales/undo-last")
 async def undo_last_sale(_: bool = Depends(verify_pin)):
-    # Get the most recent undo-able sale
-    five_minutes_ago = datetime.now() - timedelta(minutes=5)
-    recent_undo = await undo_log_collection.find_one(
-        {"timestamp": {"$gte": five_minutes_ago}},
-        sort=[("timestamp", -1)]
-    )
+    # Claim the most recent undo-able sale; the TTL monitor runs about once a
+    # minute, so the window is enforced here as well
+    window = undo_window(await settings_cache.get())
+    entry = await recent_sales.claim(datetime.now() - window)
     
-    if not recent_undo:
-        raise HTTPException(status_code=400, detail="No recent sale to undo (within 5 minutes)")
+    if not entry or "items" not in entry:
+        minutes = int(window.total_seconds() // 60)
+        raise HTTPException(status_code=400, detail=f"No recent sale to undo (within {minutes} minutes)")
     
-    # Get the sale details
     try:
-        sale_id = ObjectId(recent_undo["sale_id"])
+        sale_id = ObjectId(entry["sale_id"])
     except:
         raise HTTPException(status_code=400, detail="Invalid sale ID in undo log")
     
-    sale = await sales_collection.find_one({"_id": sale_id})
-    if not sale:
-        raise HTTPException(status_code=404, detail="Sale not found")
-    
-    # Revert product quantity
-    try:
-        product_id = ObjectId(sale["product_id"])
-    except:
-        raise HTTPException(status_code=400, detail="Invalid product ID in sale")
+    # A journaled sale must reach Mongo before it can be deleted there
+    if sale_journal:
+        await sale_journal.flush()
     
-    await products_collection.update_one(
-        {"_id": product_id},
-        {"$inc": {"quantity": sale["quantity"]}}
-    )
+    # The snapshot has everything needed, so each collection gets one write
+    quantities, bottles_taken = {}, {}
+    for item in entry["items"]:
+        quantities[item["product_id"]] = quantities.get(item["product_id"], 0) + item["quantity"]
+        if item["bottle_taken"]:
+            bottles_taken[item["product_id"]] = bottles_taken.get(item["product_id"], 0) + item["quantity"]
+    now = datetime.now()
+    writes = [
+        products_collection.bulk_write([
+            UpdateOne({"_id": ObjectId(product_id)}, {"$inc": {"quantity": quantity}})
+            for product_id, quantity in quantities.items()
+        ], ordered=False),
+        record_movements([movement(product_id, "undo", quantity, now, entry["sale_id"]) for product_id, quantity in quantities.items()]),
+        sales_collection.delete_one({"_id": sale_id})
+    ]
+    if "sold_by" in entry:
+        # Entries written before daily rollups existed can't be taken off them
+        writes.append(apply_rollups([entry], -1))
+    if bottles_taken:
+        writes.append(bottles_collection.bulk_write([
+            UpdateOne({"product_id": product_id}, {"$inc": {"bottles_taken": -count}})
+            for product_id, count in bottles_taken.items()
+        ], ordered=False))
+    await asyncio.gather(*writes)
+    for product_id, quantity in quantities.items():
+        product_catalog.adjust_quantity(product_id, quantity)
     
-    # Revert bottle count if applicable
-    if sale["bottle_taken"]:
-        await bottles_collection.update_one(
-            {"product_id": sale["product_id"]},
-            {"$inc": {"bottles_taken": -sale["quantity"]}}
+    return {"message": "Last sale undone successfully", "sale_id": entry["sale_id"]}
+
+# Daily rollups: one daily_stats document per day ("YYYY-MM-DD"), kept up
+# to date with $inc by every path that records or reverts a sale
+def stat_key(name: str) -> str:
+    # Seller names become field names, which can't contain dots or start with $
+    return name.replace(".", "\uff0e").replace("$", "\uff04")
+
+def unstat_key(key: str) -> str:
+    return key.replace("\uff0e", ".").replace("\uff04", "$")
+
+def sale_increments(sale: dict, sign: int = 1) -> dict:
+    # Works on sale documents and on undo entries, which keep the same fields
+    items = sale.get("items", [sale])
+    amount = sum(item["total_amount"] for item in items)
+    increments = {
+        "total_sales_amount": sign * amount,
+        "sales_count": sign,
+        f"sales_by_seller.{stat_key(sale['sold_by'])}": sign * amount,
+        f"sales_by_payment_method.{sale['payment_method']}": sign * amount
+    }
+    for item in items:
+        for field, value in (
+            (f"products.{item['product_id']}.quantity", item["quantity"]),
+            (f"products.{item['product_id']}.amount", item["total_amount"]),
+            ("bottles_taken", item["quantity"] if item["bottle_taken"] else 0)
+        ):
+            increments[field] = increments.get(field, 0) + sign * value
+    return increments
+
+def rollup_writes(sales: list, sign: int = 1) -> list:
+    # One update per day touched, with the increments of all its sales merged
+    days = {}
+    for sale in sales:
+        day = days.setdefault(sale["timestamp"].date(), {"$inc": {}, "$set": {}})
+        for field, value in sale_increments(sale, sign).items():
+            day["$inc"][field] = day["$inc"].get(field, 0) + value
+        for item in sale.get("items", [sale]):
+            if "product_name" in item:
+                day["$set"][f"products.{item['product_id']}.name"] = item["product_name"]
+    # Only today's document is created here. An earlier day without one (an
+    # offline upload, a day from before rollups) is left to the rebuild on
+    # first read, which sees these sales too; creating it would hide the rest
+    today = datetime.now().date()
+    writes = []
+    for date, update in days.items():
+        update["$setOnInsert"] = {"day": datetime.combine(date, datetime.min.time())}
+        if not update["$set"]:
+            del update["$set"]
+        writes.append(UpdateOne({"_id": date.isoformat()}, update, upsert=date == today))
+    return writes
+
+async def apply_rollups(sales: list, sign: int = 1, session=None):
+    writes = rollup_writes(sales, sign)
+    if writes:
+        await daily_stats_collection.bulk_write(writes, ordered=False, session=session)
+
+async def rebuild_daily_stats(target_date, replace: bool = True) -> dict:
+    """Recomputes one day's rollup from the raw sales and bottle returns.
+
+    With `replace=False` the result is only stored if the day has no rollup
+    yet, so increments that land while the sales are read are never
+    overwritten; the stored document is returned either way.
+    """
+    start_of_day = datetime.combine(target_date, datetime.min.time())
+    end_of_day = datetime.combine(target_date, datetime.max.time())
+    document = {"_id": target_date.isoformat(), "day": start_of_day, "total_sales_amount": 0, "sales_count": 0,
+                "sales_by_seller": {}, "sales_by_payment_method": {}, "products": {}, "bottles_taken": 0, "bottles_returned": 0}
+    async for sale in sales_collection.find({"timestamp": {"$gte": start_of_day, "$lte": end_of_day}}):
+        for field, value in sale_increments(sale).items():
+            parent = document
+            *path, leaf = field.split(".")
+            for key in path:
+                parent = parent.setdefault(key, {})
+            parent[leaf] = parent.get(leaf, 0) + value
+        for item in sale.get("items", [sale]):
+            document["products"][item["product_id"]]["name"] = item["product_name"]
+    async for bottle_return in db.bottle_returns.find({"timestamp": {"$gte": start_of_day, "$lte": end_of_day}}):
+        document["bottles_returned"] += bottle_return["bottles_returned"]
+    if replace:
+        await daily_stats_collection.replace_one({"_id": document["_id"]}, document, upsert=True)
+        return document
+    try:
+        return await daily_stats_collection.find_one_and_update(
+            {"_id": document["_id"]}, {"$setOnInsert": document}, upsert=True, return_document=ReturnDocument.AFTER
         )
-    
-    # Remove from sales and undo log
-    await sales_collection.delete_one({"_id": sale_id})
-    await undo_log_collection.delete_one({"_id": recent_undo["_id"]})
-    
-    return {"message": "Last sale undone successfully"}
+    except DuplicateKeyError:
+        # A sale's upsert created the day first
+        return await daily_stats_collection.find_one({"_id": document["_id"]})
+
+async def rebuild_daily_stats_range(start_date, end_date):
+    day = start_date
+    while day <= end_date:
+        document = await rebuild_daily_stats(day)
+        print(f"Rebuilt {document['_id']}: {document['sales_count']} sales, {document['total_sales_amount']:,} total")
+        day += timedelta(days=1)
 
 # Bottle tracking endpoints
 @app.post("/bottles/return")
 async def return_bottles(bottle_return: BottleReturnWithCustomer, _: bool = Depends(verify_pin)):
-    product = await products_collection.find_one({"name": bottle_return.product_name})
+    product = product_catalog.find_by_name(bottle_return.product_name)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     if not product["is_bottled"]:
@@ -510,6 +2306,12 @@ async def return_bottles(bottle_return: BottleReturnWithCustomer, _: bool = Depe
         "customer_name": bottle_return.customer_name,
         "timestamp": datetime.now()
     })
+    today = datetime.now().date()
+    await daily_stats_collection.update_one(
+        {"_id": today.isoformat()},
+        {"$inc": {"bottles_returned": bottle_return.bottles_returned}, "$setOnInsert": {"day": datetime.combine(today, datetime.min.time())}},
+        upsert=True
+    )
     return {"message": f"Returned {bottle_return.bottles_returned} bottles for {bottle_return.product_name} by {bottle_return.customer_name}"}
 
 @app.get("/bottles/status")
@@ -517,7 +2319,9 @@ async def get_bottle_status(_: bool = Depends(verify_pin)):
     bottle_status = []
     
     # Get all bottled products
-    async for product in products_collection.find({"is_bottled": True}):
+    for product in product_catalog.all():
+        if not product["is_bottled"]:
+            continue
         bottle_data = await bottles_collection.find_one({"product_id": str(product["_id"])})
         
         taken = bottle_data["bottles_taken"] if bottle_data else 0
@@ -544,25 +2348,11 @@ async def get_daily_summary(date: Optional[str] = None, _: bool = Depends(verify
     else:
         target_date = datetime.now().date()
     
-    # Date range for the day
-    start_of_day = datetime.combine(target_date, datetime.min.time())
-    end_of_day = datetime.combine(target_date, datetime.max.time())
-    
-    # Get daily sales
-    daily_sales = []
-    total_sales_amount = 0
-    sales_by_seller = {}
-    
-    async for sale in sales_collection.find({
-        "timestamp": {"$gte": start_of_day, "$lte": end_of_day}
-    }):
-        daily_sales.append(sale)
-        total_sales_amount += sale["total_amount"]
-        
-        seller = sale["sold_by"]
-        if seller not in sales_by_seller:
-            sales_by_seller[seller] = 0
-        sales_by_seller[seller] += sale["total_amount"]
+    # The day's totals are one rollup document; days from before rollups
+    # existed are built from the raw sales on first read
+    stats = await daily_stats_collection.find_one({"_id": target_date.isoformat()})
+    if not stats:
+        stats = await rebuild_daily_stats(target_date, replace=False)
     
     # Get bottle statistics
     total_bottles_taken = 0
@@ -574,22 +2364,169 @@ async def get_daily_summary(date: Optional[str] = None, _: bool = Depends(verify
     
     # Get low stock products
     low_stock_products = []
-    settings = await settings_collection.find_one({})
-    threshold = settings.get("low_stock_threshold", 5) if settings else 5
+    settings = await settings_cache.get()
+    threshold = settings.get("low_stock_threshold", 5)
     
-    async for product in products_collection.find({"quantity": {"$lt": threshold}}):
-        low_stock_products.append(product_dict_to_response(product))
+    for product in product_catalog.all():
+        if product["quantity"] < threshold:
+            low_stock_products.append(product_dict_to_response(product))
     
     return DailySummary(
         date=target_date.isoformat(),
-        total_sales_amount=total_sales_amount,
-        sales_by_seller=sales_by_seller,
+        total_sales_amount=stats.get("total_sales_amount", 0),
+        sales_count=stats.get("sales_count", 0),
+        # Undone sales leave zero entries behind
+        sales_by_seller={unstat_key(seller): amount for seller, amount in stats.get("sales_by_seller", {}).items() if amount},
+        sales_by_payment_method={method: amount for method, amount in stats.get("sales_by_payment_method", {}).items() if amount},
+        quantity_by_product={product.get("name", product_id): product["quantity"] for product_id, product in stats.get("products", {}).items() if product.get("quantity")},
         bottles_taken=total_bottles_taken,
         bottles_returned=total_bottles_returned,
         outstanding_bottles=total_bottles_taken - total_bottles_returned,
         low_stock_products=low_stock_products
     )
 
+@app.post("/summary/daily/rebuild")
+async def rebuild_daily_summary(date: str, _: bool = Depends(verify_pin)):
+    try:
+        target_date = datetime.fromisoformat(date).date()
+    except:
+        raise HTTPException(status_code=400, detail="Invalid date format")
+    document = await rebuild_daily_stats(target_date)
+    return {"message": f"Rebuilt summary for {document['_id']}", "sales_count": document["sales_count"]}
+
+MAX_HOURLY_RANGE = timedelta(days=31)
+
+def bucket_start(day: datetime, granularity: str) -> datetime:
+    # Python equivalent of $dateTrunc for whole days; weeks start on Monday
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
+
+def add_to_bucket(buckets: dict, start: datetime, amount, count, sellers=(), payment_methods=(), products=()):
+    bucket = buckets.setdefault(start, {"start": start, "total_sales_amount": 0, "sales_count": 0, "sales_by_seller": {}, "sales_by_payment_method": {}, "sales_by_product": {}})
+    bucket["total_sales_amount"] += amount
+    bucket["sales_count"] += count
+    for seller, amount in sellers:
+        bucket["sales_by_seller"][seller] = bucket["sales_by_seller"].get(seller, 0) + amount
+    for method, amount in payment_methods:
+        bucket["sales_by_payment_method"][method] = bucket["sales_by_payment_method"].get(method, 0) + amount
+    for name, quantity, amount in products:
+        totals = bucket["sales_by_product"].setdefault(name, {"quantity": 0, "amount": 0})
+        totals["quantity"] += quantity
+        totals["amount"] += amount
+
+async def add_rollups(buckets: dict, start: datetime, end: datetime, granularity: str) -> tuple:
+    """Fills buckets from the daily_stats of every whole day in [start, end).
+
+    Returns how many days were covered and the spans still to be read from
+    the sales: partial days at either end and days without a rollup.
+    """
+    first_day = datetime.combine(start.date(), datetime.min.time())
+    if first_day < start:
+        first_day += timedelta(days=1)
+    end_day = datetime.combine(end.date(), datetime.min.time())
+    if end_day <= first_day:
+        return 0, [(start, end)]
+    
+    documents = await daily_stats_collection.find({"_id": {"$gte": first_day.date().isoformat(), "$lt": end_day.date().isoformat()}}).to_list(None)
+    covered = {stats["_id"] for stats in documents}
+    for stats in documents:
+        # Undone sales leave zero entries behind
+        add_to_bucket(
+            buckets, bucket_start(stats["day"], granularity), stats.get("total_sales_amount", 0), stats.get("sales_count", 0),
+            [(unstat_key(seller), amount) for seller, amount in stats.get("sales_by_seller", {}).items() if amount],
+            [(method, amount) for method, amount in stats.get("sales_by_payment_method", {}).items() if amount],
+            [(product.get("name", product_id), product["quantity"], product.get("amount", 0)) for product_id, product in stats.get("products", {}).items() if product.get("quantity")]
+        )
+    
+    spans = [(start, first_day)] if start < first_day else []
+    day = first_day
+    while day < end_day:
+        if day.date().isoformat() not in covered:
+            if spans and spans[-1][1] == day:
+                spans[-1] = (spans[-1][0], day + timedelta(days=1))
+            else:
+                spans.append((day, day + timedelta(days=1)))
+        day += timedelta(days=1)
+    if end_day < end:
+        if spans and spans[-1][1] == end_day:
+            spans[-1] = (spans[-1][0], end)
+        else:
+            spans.append((end_day, end))
+    return len(covered), spans
+
+async def add_sales(buckets: dict, spans: list, granularity: str):
+    # One aggregation over all spans: each facet groups by the truncated timestamp
+    truncate = {"date": "$timestamp", "unit": granularity}
+    if granularity == "week":
+        truncate["startOfWeek"] = "monday"
+    ranges = [{"timestamp": {"$gte": span_start, "$lt": span_end}} for span_start, span_end in spans]
+    pipeline = [
+        {"$match": ranges[0] if len(ranges) == 1 else {"$or": ranges}},
+        {"$set": {"bucket": {"$dateTrunc": truncate}}},
+        {"$facet": {
+            "totals": [{"$group": {"_id": "$bucket", "amount": {"$sum": "$total_amount"}, "count": {"$sum": 1}}}],
+            "sellers": [{"$group": {"_id": {"bucket": "$bucket", "key": "$sold_by"}, "amount": {"$sum": "$total_amount"}}}],
+            "payment_methods": [{"$group": {"_id": {"bucket": "$bucket", "key": "$payment_method"}, "amount": {"$sum": "$total_amount"}}}],
+            "products": [
+                {"$unwind": {"path": "$items", "preserveNullAndEmptyArrays": True}},
+                {"$group": {
+                    "_id": {"bucket": "$bucket", "key": item_field("product_name")},
+                    "quantity": {"$sum": item_field("quantity")},
+                    "amount": {"$sum": item_field("total_amount")}
+                }}
+            ]
+        }}
+    ]
+    result = (await sales_collection.aggregate(pipeline).to_list(1))[0]
+    for row in result["totals"]:
+        add_to_bucket(buckets, row["_id"], row["amount"], row["count"])
+    for row in result["sellers"]:
+        add_to_bucket(buckets, row["_id"]["bucket"], 0, 0, sellers=[(row["_id"]["key"], row["amount"])])
+    for row in result["payment_methods"]:
+        add_to_bucket(buckets, row["_id"]["bucket"], 0, 0, payment_methods=[(row["_id"]["key"], row["amount"])])
+    for row in result["products"]:
+        add_to_bucket(buckets, row["_id"]["bucket"], 0, 0, products=[(row["_id"]["key"], row["quantity"], row["amount"])])
+
+@app.get("/summary/range", response_model=RangeSummary)
+async def get_range_summary(
+    start: str,
+    end: str,
+    granularity: str = Query("day", pattern="^(hour|day|week|month)$"),
+    _: bool = Depends(verify_pin)
+):
+    try:
+        start_time = datetime.fromisoformat(start)
+        end_time = datetime.fromisoformat(end)
+    except:
+        raise HTTPException(status_code=400, detail="Invalid date format")
+    if len(end) == 10:
+        # A bare end date includes that whole day
+        end_time += timedelta(days=1)
+    if end_time <= start_time:
+        raise HTTPException(status_code=400, detail="end must be after start")
+    if granularity == "hour" and end_time - start_time > MAX_HOURLY_RANGE:
+        raise HTTPException(status_code=400, detail=f"Hourly ranges are limited to {MAX_HOURLY_RANGE.days} days")
+    
+    # Whole days come from the daily rollups; hours, partial days and days
+    # without a rollup are aggregated from the sales
+    buckets = {}
+    rollup_days, spans = 0, [(start_time, end_time)]
+    if granularity != "hour":
+        rollup_days, spans = await add_rollups(buckets, start_time, end_time, granularity)
+    if spans:
+        await add_sales(buckets, spans, granularity)
+    
+    return RangeSummary(
+        start=start_time,
+        end=end_time,
+        granularity=granularity,
+        rollup_days=rollup_days,
+        buckets=[buckets[key] for key in sorted(buckets) if buckets[key]["sales_count"]]
+    )
+
 # Export endpoint (stub)
 @app.get("/export/daily-summary")
 async def export_daily_summary(date: Optional[str] = None, _: bool = Depends(verify_pin)):
@@ -671,10 +2608,18 @@ async def export_daily_summary(date: Optional[str] = None, _: bool = Depends(ver
     })
 
 # Receipt preview endpoint
+async def find_sale(sale_id: ObjectId) -> Optional[dict]:
+    # Journaled sales may not have been flushed to Mongo yet
+    if sale_journal:
+        sale = sale_journal.get(sale_id)
+        if sale:
+            return sale
+    return await sales_collection.find_one({"_id": sale_id})
+
 @app.get("/receipt/preview/{sale_id}")
 async def get_receipt_preview(sale_id: str, _: bool = Depends(verify_pin)):
     try:
-        sale = await sales_collection.find_one({"_id": ObjectId(sale_id)})
+        sale = await find_sale(ObjectId(sale_id))
     except:
         raise HTTPException(status_code=400, detail="Invalid sale ID")
     
@@ -698,7 +2643,7 @@ async def get_receipt_preview(sale_id: str, _: bool = Depends(verify_pin)):
 # PDF receipt endpoint
 @app.get("/receipt/pdf/{sale_id}")
 async def get_receipt_pdf(sale_id: str, _: bool = Depends(verify_pin)):
-    sale = await sales_collection.find_one({"_id": ObjectId(sale_id)})
+    sale = await find_sale(ObjectId(sale_id))
     if not sale:
         raise HTTPException(status_code=404, detail="Sale not found")
     buffer = BytesIO()
@@ -725,6 +2670,40 @@ async def health_check():
     return {"status": "healthy", "timestamp": datetime.now()}
 
 # Startup event
+async def ensure_sales_timeseries():
+    if not await db.list_collection_names(filter={"name": TIMESERIES_COLLECTION}):
+        await db.create_collection(TIMESERIES_COLLECTION, timeseries={"timeField": "timestamp", "metaField": "meta", "granularity": "minutes"})
+        print(f"Created time-series collection {TIMESERIES_COLLECTION}")
+
+async def migrate_sales_timeseries(batch_size: int = 1000):
+    """Copies `sales` into the `sales_ts` time-series collection.
+
+    Runs oldest first and can be re-run: it resumes after the newest sale
+    already copied. `sales` is left as it is.
+    """
+    await ensure_sales_timeseries()
+    target = db[TIMESERIES_COLLECTION]
+    latest = await target.find_one({}, {"timestamp": 1}, sort=[("timestamp", -1)])
+    filter_dict, copied_ids = {}, set()
+    if latest:
+        filter_dict["timestamp"] = {"$gte": latest["timestamp"]}
+        copied_ids = {sale["_id"] async for sale in target.find({"timestamp": latest["timestamp"]}, {"_id": 1})}
+    copied = 0
+    batch = []
+    async for sale in db.sales.find(filter_dict).sort("timestamp", 1):
+        if sale["_id"] in copied_ids:
+            continue
+        batch.append(sale_document({key: value for key, value in sale.items() if key != "meta"}, timeseries=True))
+        if len(batch) == batch_size:
+            await target.insert_many(batch, ordered=False)
+            copied += len(batch)
+            batch = []
+            print(f"Copied {copied} sales")
+    if batch:
+        await target.insert_many(batch, ordered=False)
+        copied += len(batch)
+    print(f"Copied {copied} sales into {TIMESERIES_COLLECTION}; start the API with SALES_STORAGE=timeseries to use it")
+
 @app.on_event("startup")
 async def startup_event():
     # Initialize default settings if not exists
@@ -734,9 +2713,64 @@ async def startup_event():
         await settings_collection.insert_one({
             "pin": default_pin_hash,
             "low_stock_threshold": 5,
+            "undo_window_minutes": 5,
             "receipt_preview": True
         })
         print("Initialized default settings with PIN: 1234")
+    global transactions_supported
+    # Time-series collections can't be written inside a transaction, so sales
+    # fall back to compensating writes
+    transactions_supported = not TIMESERIES_SALES and await detect_transaction_support()
+    if TIMESERIES_SALES:
+        await ensure_sales_timeseries()
+    await ensure_indexes(await settings_cache.get())
+    await barcode_index.load()
+    if stock_counters:
+        # Leftover deltas from the last run must be in products.quantity before it is cached
+        await stock_counters.fold()
+        background_tasks.append(asyncio.create_task(stock_counters.run()))
+    await product_catalog.load()
+    if not TIMESERIES_SALES:
+        # Time-series measurements can't be updated in place; the migration writes these fields
+        await backfill_search_fields()
+    await take_inventory_snapshots()
+    background_tasks.append(asyncio.create_task(run_inventory_snapshots()))
+    if SETTINGS_CHANGE_STREAM:
+        background_tasks.append(asyncio.create_task(watch_settings()))
+    if CATALOG_CHANGE_STREAM:
+        background_tasks.append(asyncio.create_task(watch_catalog()))
+    if sale_journal:
+        await sale_journal.start()
+    if not await daily_stats_collection.find_one({}):
+        # First start with rollups: today's earlier sales predate them and the
+        # next sale's increment would otherwise create a partial document
+        await rebuild_daily_stats(datetime.now().date())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if sale_journal:
+        # Drain whatever the flusher hadn't inserted yet
+        await sale_journal.close()
+    if stock_counters:
+        await stock_counters.fold(stock_counters.dirty)
+
+# Cache statistics
+@app.get("/cache/stats")
+async def get_cache_stats(_: bool = Depends(verify_pin)):
+    return {
+        "settings": settings_cache.stats(),
+        "barcodes": barcode_index.stats(),
+        "catalog": product_catalog.stats(),
+        "sale_journal": sale_journal.stats() if sale_journal else None,
+        "idempotency": idempotency_store.stats(),
+        "stock_counters": stock_counters.stats() if stock_counters else None,
+        "recent_sales": recent_sales.stats(),
+        "compression": compressed_bodies.stats()
+    }
 
 # Add to your summary or a new endpoint
 @app.get("/customers/{customer_id}/balance")
@@ -758,14 +2792,40 @@ async def add_customer(customer: Customer, _: bool = Depends(verify_pin)):
     return CustomerResponse(**customer_dict)
 
 @app.get("/customers", response_model=List[CustomerResponse])
-async def list_customers(_: bool = Depends(verify_pin)):
-    customers = []
-    async for cust in db.customers.find():
-        cust["id"] = str(cust["_id"])
-        customers.append(CustomerResponse(**cust))
-    return customers
+async def list_customers(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    _: bool = Depends(verify_pin)
+):
+    selected = sparse_fields(fields, CustomerResponse)
+    filter_dict = {"_id": {"$gt": decode_cursor(cursor)["id"]}} if cursor else {}
+    projection = {name: 1 for name in selected if name != "id"} if selected else None
+    query = db.customers.find(filter_dict, projection).sort("_id", 1)
+    headers = {}
+    if limit:
+        documents = await query.limit(limit + 1).to_list(limit + 1)
+        if len(documents) > limit:
+            documents = documents[:limit]
+            headers["X-Next-Cursor"] = encode_cursor({"id": str(documents[-1]["_id"])})
+    else:
+        documents = await query.to_list(None)
+    customers = [
+        {"id": str(cust["_id"]), "name": cust.get("name"), "phone": cust.get("phone"), "email": cust.get("email")}
+        for cust in documents
+    ]
+    return FastJSONResponse(trim_fields(customers, selected), headers=headers)
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["migrate-sales-timeseries"]:
+        asyncio.run(migrate_sales_timeseries())
+        sys.exit()
+    if sys.argv[1:2] == ["rebuild-daily-stats"]:
+        # python main.py rebuild-daily-stats START [END], dates as YYYY-MM-DD
+        start_date = datetime.fromisoformat(sys.argv[2]).date()
+        end_date = datetime.fromisoformat(sys.argv[3]).date() if len(sys.argv) > 3 else start_date
+        asyncio.run(rebuild_daily_stats_range(start_date, end_date))
+        sys.exit()
     uvicorn.run(
         "main:app",
         host="0.0.0.0",